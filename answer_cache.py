@@ -0,0 +1,79 @@
+import copy
+import itertools
+import threading
+from collections import OrderedDict
+
+from minhash import MinHasher, LSHIndex
+from text_utils import char_shingles, jaccard, negation_terms
+
+
+class SemanticAnswerCache:
+    """Similarity-based answer cache for paraphrased queries.
+
+    Queries are indexed by MinHash signatures of their character shingles in
+    LSH buckets. A lookup hits when a cached query is at least `threshold`
+    similar, has the same top source, and its retrieved source set overlaps
+    the new one by at least `min_source_overlap` (Jaccard), and uses the same
+    negation words ("working" and "not working" retrieve the same sources but
+    need opposite answers). Entries are
+    evicted least-recently-used beyond `max_entries`.
+    """
+
+    def __init__(self, threshold=0.5, min_source_overlap=0.6, max_entries=2048, num_perm=64, bands=32):
+        self.threshold = threshold
+        self.min_source_overlap = min_source_overlap
+        self.max_entries = max_entries
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.lsh = LSHIndex(num_perm=num_perm, bands=bands)
+        self.entries = OrderedDict()   # id -> (signature, source_ids, top source, negations, response)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def lookup(self, query, source_ids):
+        """Return a copy of the best cached response for a similar query with matching sources, or None"""
+        sig = self.hasher.signature(char_shingles(query))
+        negations = negation_terms(query)
+        sources = frozenset(source_ids)
+        with self._lock:
+            self.lookups += 1
+            if sig is None or not source_ids:
+                return None
+            best, best_sim = None, self.threshold
+            for key in self.lsh.candidates(sig):
+                cached_sig, cached_ids, cached_top, cached_negations, response = self.entries[key]
+                if cached_top != source_ids[0] or cached_negations != negations:
+                    continue
+                if jaccard(cached_ids, sources) < self.min_source_overlap:
+                    continue
+                sim = MinHasher.similarity(sig, cached_sig)
+                if sim >= best_sim:
+                    best, best_sim = key, sim
+            if best is None:
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best)
+            return copy.deepcopy(self.entries[best][4])
+
+    def store(self, query, source_ids, response):
+        sig = self.hasher.signature(char_shingles(query))
+        if sig is None or not source_ids:
+            return
+        with self._lock:
+            key = next(self._ids)
+            self.entries[key] = (sig, frozenset(source_ids), source_ids[0], negation_terms(query),
+                                 copy.deepcopy(response))
+            self.lsh.insert(key, sig)
+            while len(self.entries) > self.max_entries:
+                old_key, (old_sig, *_) = self.entries.popitem(last=False)
+                self.lsh.remove(old_key, old_sig)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            }
@@ -1,9 +1,14 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, render_template, g, Response
 from flask_cors import CORS
-from rag_service import RAGService
-from billing_service import BillingService
+from rag_service import RAGService, FINAL_K, FOLLOW_UP_FINAL_K
+from billing_service import BillingService, PAYMENT_PAGE_SIZE, DUE_WINDOW_MAX_DAYS
 from recharge_service import RechargeService
+from responses import json_response
+import profiling
+from session_store import SessionStore, is_follow_up, stands_alone, record_turn, summarize_turns
 import os
+import re
+from datetime import datetime
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,10 +21,14 @@ rag_service = None
 billing_service = None
 recharge_service = None
 
+# Conversation state for multi-turn chats; in-process, so pin a session to one worker
+session_store = SessionStore()
+
 def get_rag_service():
     global rag_service
     if rag_service is None:
-        rag_service = RAGService()
+        # RETRIEVAL_SERVER=unix:/path.sock or tcp:host:port shares one index across workers
+        rag_service = RAGService(retrieval_server=os.environ.get("RETRIEVAL_SERVER"))
     return rag_service
 
 def get_billing_service():
@@ -34,6 +43,35 @@ def get_recharge_service():
         recharge_service = RechargeService()
     return recharge_service
 
+# Diagnostics are off unless ADMIN_TOKEN is set. With it, admin-authorized requests
+# sending "X-Trace: 1" are traced; TRACE_REQUESTS=1 traces every request.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+TRACE_REQUESTS = os.environ.get("TRACE_REQUESTS") == "1"
+
+def _admin_authorized():
+    return bool(ADMIN_TOKEN) and request.headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+@app.before_request
+def start_request_trace():
+    if not ADMIN_TOKEN or not (TRACE_REQUESTS or (request.headers.get("X-Trace") == "1" and _admin_authorized())):
+        return
+    attrs = {"method": request.method, "path": request.path}
+    # A caller-supplied ID is recorded so traces can be joined across services,
+    # but traces are always stored under a fresh ID
+    client_trace_id = request.headers.get("X-Trace-Id", "")
+    if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", client_trace_id):
+        attrs["client_trace_id"] = client_trace_id
+    g.trace, g.trace_token = profiling.start_trace(**attrs)
+
+@app.after_request
+def finish_request_trace(response):
+    trace = g.pop("trace", None)
+    if trace is not None:
+        trace.attrs["status"] = response.status_code
+        profiling.finish_trace(trace, g.pop("trace_token"))
+        response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -43,13 +81,43 @@ def chat():
     data = request.json
     query = data.get("message")
     api_key = data.get("apiKey")
+    filters = data.get("filters")
+    # Optional field selection, e.g. "answer,escalation,path" to skip context/sources
+    fields = data.get("fields") or request.args.get("fields")
+    session_id = data.get("session_id")
     
     if not query:
-        return jsonify({"error": "No message provided"}), 400
+        return json_response({"error": "No message provided"}, 400)
+    if filters is not None and not isinstance(filters, dict):
+        return json_response({"error": "filters must be an object of column -> value(s)"}, 400)
+    if fields is not None and not (isinstance(fields, str) or
+                                   (isinstance(fields, list) and all(isinstance(f, str) for f in fields))):
+        return json_response({"error": "fields must be a comma-separated string or a list of strings"}, 400)
+    if session_id is not None and not isinstance(session_id, str):
+        return json_response({"error": "session_id must be a string"}, 400)
 
     rag = get_rag_service()
     billing = get_billing_service()
     recharge = get_recharge_service()
+
+    if filters:
+        filter_columns = rag.get_index_info()["filter_columns"]
+        unknown = sorted(set(filters) - set(filter_columns))
+        if unknown:
+            return json_response({"error": f"Cannot filter on {unknown}. Filterable columns: {filter_columns}"}, 400)
+    
+    session = session_store.get(session_id)
+    if session is None:
+        session_id, session = session_store.new_id(), {}
+    follow_up = is_follow_up(query, session)
+    hits = None
+    if follow_up:
+        # Retrieval for the message alone decides whether it really continues the conversation
+        hits = rag.retrieve(query, filters=filters)
+        follow_up = not stands_alone(hits, session)
+    
+    # Enriched queries below embed plan/billing data in the prompt, so they skip the
+    # fast path and the shared answer cache
     
     # Check query type
     billing_keywords = ["bill", "payment", "due", "pay", "invoice", "amount", "balance", "pending"]
@@ -58,27 +126,65 @@ def chat():
     is_billing_query = any(keyword in query.lower() for keyword in billing_keywords)
     is_recharge_query = any(keyword in query.lower() for keyword in recharge_keywords)
     
-    if is_recharge_query:
+    domain = "recharge" if is_recharge_query else "billing" if is_billing_query else None
+    domain_context = None
+    if follow_up and session.get("domain") and domain in (None, session["domain"]):
+        # "what about the 84 day one?" refers to the plans / bill already shown, unless
+        # the message names another subscriber
+        if not (session["domain"] == "billing" and re.search(r"\b\d{10}\b", query)):
+            domain, domain_context = session["domain"], session["domain_context"]
+    
+    if domain == "recharge":
         # Get recharge plans information
-        recharge_context = recharge.search_plans(query)
+        recharge_context = domain_context or recharge.search_plans(query)
+        domain_context = recharge_context
         
         # Enhance RAG query with recharge context
         enhanced_query = f"AVAILABLE PLANS:\n{recharge_context}\n\nUSER QUERY: {query}"
-        result = rag.answer_query(enhanced_query, api_key=api_key)
     
-    elif is_billing_query:
+    elif domain == "billing":
         # Get billing information
-        billing_context = billing.search_bills(query)
+        billing_context = domain_context or billing.search_bills(query)
+        domain_context = billing_context
         
         # Enhance RAG query with billing context
         enhanced_query = f"USER BILLING DATA:\n{billing_context}\n\nUSER QUERY: {query}"
-        result = rag.answer_query(enhanced_query, api_key=api_key)
     
+    else:
+        enhanced_query = query
+    
+    if follow_up:
+        # Retrieve only for the new message, carry the previous docs over, and send a
+        # conversation summary with fewer docs instead of a full fresh prompt
+        result = rag.answer_query(enhanced_query, api_key=api_key, filters=filters,
+                                  fast_path=False, use_cache=False, retrieval_query=query,
+                                  prior_sources=session.get("sources"),
+                                  history=summarize_turns(session["turns"]),
+                                  max_docs=FOLLOW_UP_FINAL_K, retrieved=hits)
+    elif domain:
+        result = rag.answer_query(enhanced_query, api_key=api_key, filters=filters,
+                                  fast_path=False, use_cache=False)
     else:
         # Normal RAG query
-        result = rag.answer_query(query, api_key=api_key)
+        result = rag.answer_query(query, api_key=api_key, filters=filters, retrieved=hits)
+
+    if not result.get("busy"):
+        session["domain"] = domain
+        session["domain_context"] = domain_context
+        session["sources"] = [{"source_id": r["source_id"], "score": r["score"]}
+                              for r in result.get("sources", [])[:FINAL_K]]
+        record_turn(session, query, result.get("answer", ""))
+        session_store.put(session_id, session)
+    result["session_id"] = session_id
+    result["follow_up"] = follow_up
+    if fields:
+        fields = (fields.split(",") if isinstance(fields, str) else list(fields)) + ["session_id"]
+
+    if result.get("busy"):
+        # Upstream limiter is saturated: shed load instead of queueing until timeout
+        return json_response(result, 503, {"Retry-After": "2"}, fields=fields)
     
-    return jsonify(result)
+    return json_response(result, fields=fields)
 
 @app.route("/plans", methods=["GET"])
 def get_plans():
@@ -95,7 +201,7 @@ def get_plans():
     else:
         plans = recharge.get_all_plans()
     
-    return jsonify({"plans": plans})
+    return json_response({"plans": plans})
 
 @app.route("/plans/<plan_id>", methods=["GET"])
 def get_plan_details(plan_id):
@@ -104,9 +210,9 @@ def get_plan_details(plan_id):
     plan = recharge.get_plan_by_id(plan_id)
     
     if plan:
-        return jsonify({"plan": plan})
+        return json_response({"plan": plan})
     else:
-        return jsonify({"error": "Plan not found"}), 404
+        return json_response({"error": "Plan not found"}, 404)
 
 @app.route("/bills/<mobile>", methods=["GET"])
 def get_bills(mobile):
@@ -115,87 +221,61 @@ def get_bills(mobile):
     bills = billing.get_bills(mobile)
     pending = billing.get_pending_bills(mobile)
     
-    return jsonify({
+    return json_response({
         "mobile": mobile,
         "all_bills": bills,
         "pending_bills": pending,
-        "total_due": sum(b['amount'] for b in pending)
-    })
-
-@app.route("/payments/<mobile>", methods=["GET"])
-def get_payments(mobile):
-    """Get payment history for a mobile number"""
-    billing = get_billing_service()
-    payments = billing.get_payment_history(mobile)
-    
-    return jsonify({
-        "mobile": mobile,
-        "payments": payments
+        "total_due": billing.get_total_due(mobile)
     })
 
-@app.route("/pay", methods=["POST"])
-def make_payment():
-    """Process a payment"""
-    data = request.json
-    mobile = data.get("mobile")
-    bill_id = data.get("bill_id")
-    amount = data.get("amount")
-    payment_method = data.get("payment_method", "UPI")
-    
-    if not all([mobile, bill_id, amount]):
-        return jsonify({"error": "Missing required fields"}), 400
-    
-    billing = get_billing_service()
-    result = billing.make_payment(mobile, bill_id, amount, payment_method)
-    
-    return jsonify(result)
+@app.route("/bills/due", methods=["GET"])
+def get_due_bills():
+    """Get pending bills due within a window, e.g. /bills/due?within=3d (days) or ?within=48h.
 
-@app.route("/status", methods=["GET"])
-def status():
-    rag = get_rag_service()
-    return jsonify({
-        "status": "ready" if rag.tfidf_matrix is not None else "empty (no data)",
-        "doc_count": rag.tfidf_matrix.shape[0] if rag.tfidf_matrix is not None else 0
-    })
+    Due dates have no time of day, so hours are rounded up to whole days (12h -> 1d).
+    """
+    within = request.args.get("within", "3d").strip().lower()
+    match = re.fullmatch(r"(\d+)\s*([dh]?)", within)
+    if not match:
+        return json_response({"error": "within must look like 3d or 48h"}, 400)
+    amount, unit = int(match.group(1)), match.group(2) or "d"
+    within_days = amount if unit == "d" else -(-amount // 24)
+    if within_days > DUE_WINDOW_MAX_DAYS:
+        return json_response({"error": f"within can be at most {DUE_WINDOW_MAX_DAYS}d"}, 400)
 
-if __name__ == "__main__":
-    # Pre-load services on startup
-    print("Initializing RAG Service...")
-    get_rag_service()
-    
-    print("Initializing Billing Service...")
-    get_billing_service()
-    
-    print("Initializing Recharge Service...")
-    get_recharge_service()
-    
-    print("Server starting at http://localhost:5000")
-    app.run(host='0.0.0.0', port=5000, debug=True)
-
-
-@app.route("/bills/<mobile>", methods=["GET"])
-def get_bills(mobile):
-    """Get bills for a mobile number"""
     billing = get_billing_service()
-    bills = billing.get_bills(mobile)
-    pending = billing.get_pending_bills(mobile)
+    bills = billing.get_due_bills(within_days)
     
-    return jsonify({
-        "mobile": mobile,
-        "all_bills": bills,
-        "pending_bills": pending,
-        "total_due": sum(b['amount'] for b in pending)
+    return json_response({
+        "within_days": within_days,
+        "count": len(bills),
+        "bills": bills
     })
 
 @app.route("/payments/<mobile>", methods=["GET"])
 def get_payments(mobile):
-    """Get payment history for a mobile number"""
+    """Get a page of payment history, newest first: ?since=&until= (YYYY-MM-DD), &limit=, &cursor="""
+    since = request.args.get("since")
+    until = request.args.get("until")
+    cursor = request.args.get("cursor")
+    try:
+        for value in (since, until):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+        limit = int(request.args.get("limit", PAYMENT_PAGE_SIZE))
+    except ValueError:
+        return json_response({"error": "since/until must be YYYY-MM-DD and limit an integer"}, 400)
+
     billing = get_billing_service()
-    payments = billing.get_payment_history(mobile)
+    try:
+        page = billing.get_payment_page(mobile, since=since, until=until, limit=limit, cursor=cursor)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
     
-    return jsonify({
+    return json_response({
         "mobile": mobile,
-        "payments": payments
+        "payments": page["payments"],
+        "next_cursor": page["next_cursor"]
     })
 
 @app.route("/pay", methods=["POST"])
@@ -208,21 +288,71 @@ def make_payment():
     payment_method = data.get("payment_method", "UPI")
     
     if not all([mobile, bill_id, amount]):
-        return jsonify({"error": "Missing required fields"}), 400
+        return json_response({"error": "Missing required fields"}, 400)
     
     billing = get_billing_service()
     result = billing.make_payment(mobile, bill_id, amount, payment_method)
     
-    return jsonify(result)
+    return json_response(result)
 
 @app.route("/status", methods=["GET"])
 def status():
     rag = get_rag_service()
-    return jsonify({
-        "status": "ready" if rag.tfidf_matrix is not None else "empty (no data)",
-        "doc_count": rag.tfidf_matrix.shape[0] if rag.tfidf_matrix is not None else 0
+    info = rag.get_index_info()
+    return json_response({
+        "status": "ready" if info["doc_count"] else "empty (no data)",
+        "doc_count": info["doc_count"],
+        "index_stats": info["index_stats"],
+        "retrieval_server": rag.retrieval_client.address if rag.retrieval_client else None,
+        "upstream": rag.upstream_stats(),
+        "metrics": rag.get_metrics(),
+        "answer_cache": rag.answer_cache.stats(),
+        "sessions": session_store.stats()
     })
 
+@app.route("/admin/profile", methods=["GET"])
+def admin_profile():
+    """Sample all threads for ?seconds= (default 5) and return collapsed stacks.
+
+    Output is flamegraph.pl / speedscope input; ?format=json returns the top stacks instead.
+    """
+    if not _admin_authorized():
+        return json_response({"error": "Not found"}, 404)
+    try:
+        seconds = float(request.args.get("seconds", 5))
+        interval = float(request.args.get("interval_ms", 5)) / 1000
+    except ValueError:
+        return json_response({"error": "seconds and interval_ms must be numbers"}, 400)
+    if seconds <= 0 or interval <= 0:
+        return json_response({"error": "seconds and interval_ms must be positive"}, 400)
+
+    try:
+        stacks = profiling.sample_stacks(seconds, interval)
+    except profiling.ProfilerBusy as e:
+        return json_response({"error": str(e)}, 409)
+
+    if request.args.get("format") == "json":
+        return json_response({
+            "samples": sum(stacks.values()),
+            "stacks": [{"stack": stack, "samples": n} for stack, n in stacks.most_common(50)]
+        })
+    return Response(profiling.format_collapsed(stacks), mimetype="text/plain")
+
+@app.route("/admin/traces", methods=["GET"])
+def admin_traces():
+    if not _admin_authorized():
+        return json_response({"error": "Not found"}, 404)
+    return json_response({"traces": profiling.recent_traces()})
+
+@app.route("/admin/traces/<trace_id>", methods=["GET"])
+def admin_trace(trace_id):
+    if not _admin_authorized():
+        return json_response({"error": "Not found"}, 404)
+    trace = profiling.get_trace(trace_id)
+    if trace is None:
+        return json_response({"error": "Trace not found"}, 404)
+    return json_response(trace)
+
 if __name__ == "__main__":
     # Pre-load services on startup
     print("Initializing RAG Service...")
@@ -231,10 +361,8 @@ if __name__ == "__main__":
     print("Initializing Billing Service...")
     get_billing_service()
     
+    print("Initializing Recharge Service...")
+    get_recharge_service()
+    
     print("Server starting at http://localhost:5000")
     app.run(host='0.0.0.0', port=5000, debug=True)
-
-    print("Initializing RAG Service...")
-    get_rag_service()
-    print("Server starting at http://localhost:5000")
-    app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,68 @@
+"""Replay traffic through the semantic answer cache and report its hit rate.
+
+Usage:
+    python benchmark_cache.py [queries.txt] [data_dir]
+
+queries.txt holds one customer query per line, in arrival order. Without it
+the customer text of CustomerInteractionData.csv is replayed, each followed by
+a few rephrasings of the canned support questions. No LLM calls are made:
+a miss stores a placeholder answer, as a real miss would store the LLM answer.
+"""
+import os
+import sys
+import time
+import contextlib
+import io
+
+import pandas as pd
+
+from rag_service import RAGService, FINAL_K, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_SOURCE_OVERLAP
+from answer_cache import SemanticAnswerCache
+
+PARAPHRASES = [
+    "net is slow", "internet very slow", "slow internet since morning", "internet is slow",
+    "no signal", "no signal on my phone", "phone shows no signal bars",
+    "my bill is too high", "bill higher than expected", "why is my bill so high this month",
+    "calls keep dropping", "call drops after few minutes", "my calls are dropping",
+    "activate roaming", "how to activate international roaming", "international roaming activation",
+]
+
+
+def load_traffic(path, data_dir):
+    if path:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    traffic = []
+    csv_path = os.path.join(data_dir, "CustomerInteractionData.csv")
+    if os.path.exists(csv_path):
+        df = pd.read_csv(csv_path, usecols=["CustomerInteractionRawText"])
+        traffic.extend(df["CustomerInteractionRawText"].dropna().astype(str).tolist())
+    return traffic + PARAPHRASES
+
+
+def main(queries_path=None, data_dir="data"):
+    traffic = load_traffic(queries_path, data_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        rag = RAGService(data_dir=data_dir)
+    cache = SemanticAnswerCache(threshold=ANSWER_CACHE_SIMILARITY, min_source_overlap=ANSWER_CACHE_SOURCE_OVERLAP)
+
+    lookup_ms = []
+    for query in traffic:
+        sources = [r["source_id"] for r in rag.retrieve(query)[:FINAL_K]]
+        start = time.perf_counter()
+        hit = cache.lookup(query, sources)
+        lookup_ms.append((time.perf_counter() - start) * 1000)
+        if hit is None:
+            cache.store(query, sources, {"answer": f"answer for: {query}"})
+        else:
+            print(f"HIT  {query!r:<45} -> {hit['answer']!r}")
+
+    stats = cache.stats()
+    lookup_ms.sort()
+    print(f"\nReplayed {len(traffic)} queries")
+    print(f"Hits: {stats['hits']}  Hit rate: {stats['hit_rate']:.1%}  Entries: {stats['entries']}")
+    print(f"Lookup latency p50: {lookup_ms[len(lookup_ms) // 2]:.3f} ms  max: {lookup_ms[-1]:.3f} ms")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None, sys.argv[2] if len(sys.argv) > 2 else "data")
@@ -0,0 +1,122 @@
+"""Compare TF-IDF index build options on the local data folder.
+
+Usage:
+    python benchmark_index.py [data_dir]
+
+For every configuration the index is built into a temporary file and the
+report shows pickle size, matrix memory, load time, query latency and
+recall@k against the exact float64 TF-IDF baseline (a deduplicated hit
+covers the rows collapsed into it).
+"""
+import os
+import sys
+import time
+import tempfile
+import contextlib
+import io
+
+import pandas as pd
+
+from rag_service import RAGService, TOP_K_RETRIEVE
+
+CONFIGS = [
+    ("tfidf-float64 (baseline)", {"vectorizer_mode": "tfidf", "dtype": "float64", "dedup": False}),
+    ("tfidf-float32", {"vectorizer_mode": "tfidf", "dtype": "float32", "dedup": False}),
+    ("tfidf-float32 min_df=2", {"vectorizer_mode": "tfidf", "dtype": "float32", "min_df": 2, "dedup": False}),
+    ("tfidf-float32 max_features=500", {"vectorizer_mode": "tfidf", "dtype": "float32", "max_features": 500, "dedup": False}),
+    ("hashing-float32", {"vectorizer_mode": "hashing", "dtype": "float32", "dedup": False}),
+    ("tfidf-float32 dedup", {"vectorizer_mode": "tfidf", "dtype": "float32", "dedup": True}),
+]
+
+SAMPLE_QUERIES = [
+    "internet is very slow",
+    "no signal on my phone",
+    "my bill is too high this month",
+    "how to activate international roaming",
+    "calls keep dropping",
+    "I want to port out to another network",
+]
+
+
+def load_queries(data_dir):
+    """Canned queries plus the raw customer text from the interaction logs"""
+    queries = list(SAMPLE_QUERIES)
+    path = os.path.join(data_dir, "CustomerInteractionData.csv")
+    if os.path.exists(path):
+        df = pd.read_csv(path, usecols=["CustomerInteractionRawText"])
+        queries.extend(df["CustomerInteractionRawText"].dropna().astype(str).tolist())
+    return queries
+
+
+def quiet(fn, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn(*args, **kwargs)
+
+
+def run_config(data_dir, options, queries, tmp_dir, name):
+    index_path = os.path.join(tmp_dir, f"{name}.pkl")
+    quiet(RAGService, data_dir=data_dir, index_path=index_path, **options)
+
+    start = time.perf_counter()
+    rag = quiet(RAGService, data_dir=data_dir, index_path=index_path, **options)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    # A representative stands in for the rows collapsed into it
+    members = {d["source_id"]: [d["source_id"]] + d.get("duplicate_source_ids", []) for d in rag.metadata}
+
+    results = []
+    latencies = []
+    for q in queries:
+        start = time.perf_counter()
+        hits = rag.retrieve(q)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([members[h["source_id"]] for h in hits])
+
+    latencies.sort()
+    return {
+        "docs": len(rag.metadata),
+        "pickle_bytes": os.path.getsize(index_path),
+        "matrix_bytes": rag.index_size_bytes(),
+        "load_ms": load_ms,
+        "p50_ms": latencies[len(latencies) // 2],
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1],
+        "results": results,
+    }
+
+
+def recall_at_k(results, reference, k):
+    scores = []
+    for got, expected in zip(results, reference):
+        expected = expected[:k]
+        if not expected:
+            continue
+        covered = {source_id for ids in got[:k] for source_id in ids}
+        scores.append(len(covered & set(expected)) / len(expected))
+    return sum(scores) / len(scores) if scores else 0.0
+
+
+def main(data_dir="data"):
+    queries = load_queries(data_dir)
+    print(f"Benchmarking {len(CONFIGS)} index configurations over {len(queries)} queries\n")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rows = []
+        reference = None
+        for i, (name, options) in enumerate(CONFIGS):
+            stats = run_config(data_dir, options, queries, tmp_dir, f"config_{i}")
+            if reference is None:
+                reference = [[ids[0] for ids in hits] for hits in stats["results"]]
+            rows.append((name, stats))
+
+    header = f"{'config':<32} {'docs':>5} {'pickle KB':>10} {'matrix KB':>10} {'load ms':>8} {'p50 ms':>7} {'p95 ms':>7} {'recall@5':>9} {'recall@' + str(TOP_K_RETRIEVE):>9}"
+    print(header)
+    print("-" * len(header))
+    for name, stats in rows:
+        print(f"{name:<32} {stats['docs']:>5} {stats['pickle_bytes'] / 1024:>10.1f} {stats['matrix_bytes'] / 1024:>10.1f} "
+              f"{stats['load_ms']:>8.2f} {stats['p50_ms']:>7.3f} {stats['p95_ms']:>7.3f} "
+              f"{recall_at_k(stats['results'], reference, 5):>9.3f} "
+              f"{recall_at_k(stats['results'], reference, TOP_K_RETRIEVE):>9.3f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "data")
@@ -0,0 +1,77 @@
+"""Compare bytes on the wire and serialization CPU for API responses.
+
+Usage:
+    python benchmark_responses.py [iterations]
+
+Payloads are built from the local services (no LLM call): /plans, /bills/<mobile>
+and a retrieval-only /chat result. Each is measured with Flask-style json
+(sorted keys, indented in debug), compact json, orjson, then gzip / brotli, and
+with fields=answer,escalation,path for /chat.
+"""
+import sys
+import json
+import gzip
+import time
+import contextlib
+import io
+
+import responses
+from rag_service import RAGService
+from billing_service import BillingService
+from recharge_service import RechargeService
+
+
+def build_payloads():
+    with contextlib.redirect_stdout(io.StringIO()):
+        rag = RAGService()
+        chat = rag.answer_query("customer wants to port out because of better offers", fast_path=False, use_cache=False)
+    billing = BillingService()
+    recharge = RechargeService()
+    mobile = "9811001234"
+    return {
+        "/plans": {"plans": recharge.get_all_plans()},
+        "/bills/<mobile>": {
+            "mobile": mobile,
+            "all_bills": billing.get_bills(mobile),
+            "pending_bills": billing.get_pending_bills(mobile),
+            "total_due": billing.get_total_due(mobile)
+        },
+        "/chat": chat,
+        "/chat?fields=answer,escalation,path": responses.select_fields(chat, "answer,escalation,path"),
+    }
+
+
+def cpu_us(fn, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def main(iterations=2000):
+    serializers = [
+        ("flask jsonify", lambda p: json.dumps(p, sort_keys=True, indent=2).encode("utf-8")),
+        ("json compact", lambda p: json.dumps(p, ensure_ascii=False, separators=(",", ":")).encode("utf-8")),
+    ]
+    if responses.orjson is not None:
+        serializers.append(("orjson", lambda p: responses.orjson.dumps(p)))
+
+    header = f"{'endpoint':<38} {'serializer':<14} {'raw B':>7} {'gzip B':>7} {'br B':>7} {'ser us':>8} {'+gzip us':>9} {'+br us':>8}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, payload in build_payloads().items():
+        for name, ser in serializers:
+            body = ser(payload)
+            gz = gzip.compress(body, compresslevel=responses.GZIP_LEVEL)
+            br = responses.brotli.compress(body, quality=responses.BROTLI_QUALITY) if responses.brotli else None
+            ser_us = cpu_us(lambda: ser(payload), iterations)
+            gz_us = cpu_us(lambda: gzip.compress(ser(payload), compresslevel=responses.GZIP_LEVEL), iterations // 4)
+            br_us = (cpu_us(lambda: responses.brotli.compress(ser(payload), quality=responses.BROTLI_QUALITY), iterations // 4)
+                     if br is not None else float("nan"))
+            print(f"{endpoint:<38} {name:<14} {len(body):>7} {len(gz):>7} {len(br) if br else '-':>7} "
+                  f"{ser_us:>8.1f} {gz_us:>9.1f} {br_us:>8.1f}")
+    print(f"\nBodies under {responses.COMPRESS_MIN_BYTES} bytes are sent uncompressed.")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,85 @@
+"""Throughput of in-process retrieval vs the retrieval daemon.
+
+Usage:
+    python benchmark_retrieval_server.py [seconds_per_run] [data_dir]
+
+Starts retrieval_server.py in a subprocess on a temporary Unix socket and
+runs the same query mix with 1, 4 and 16 client threads against the
+in-process index and against the daemon (pooled connections), plus one
+batched retrieve_many call per 32 queries.
+"""
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+import contextlib
+import io
+
+from rag_service import RAGService
+from retrieval_server import RetrievalClient
+from benchmark_index import load_queries
+
+
+def throughput(fn, queries, threads, seconds):
+    done = [0] * threads
+    stop = time.perf_counter() + seconds
+
+    def worker(t):
+        i = t
+        while time.perf_counter() < stop:
+            fn(queries[i % len(queries)])
+            i += threads
+            done[t] += 1
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return sum(done) / seconds
+
+
+def wait_for_server(client, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return client.info()
+        except ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError("Retrieval server did not start")
+
+
+def main(seconds=3.0, data_dir="data"):
+    queries = load_queries(data_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        local = RAGService(data_dir=data_dir)
+
+    sock_path = os.path.join(tempfile.mkdtemp(), "retrieval.sock")
+    address = f"unix:{sock_path}"
+    server = subprocess.Popen([sys.executable, "retrieval_server.py", address, data_dir],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        client = RetrievalClient(address, pool_size=16)
+        info = wait_for_server(client)
+        print(f"{info['doc_count']} documents, {len(queries)} distinct queries, {seconds:.0f}s per run\n")
+
+        batches = [queries[i:i + 32] for i in range(0, len(queries), 32)]
+        print(f"{'mode':<28} {'threads':>7} {'queries/s':>10}")
+        print("-" * 47)
+        for threads in (1, 4, 16):
+            print(f"{'in-process retrieve':<28} {threads:>7} {throughput(local.retrieve, queries, threads, seconds):>10.0f}")
+            print(f"{'daemon retrieve':<28} {threads:>7} {throughput(client.retrieve, queries, threads, seconds):>10.0f}")
+        print(f"{'in-process retrieve_many/32':<28} {1:>7} "
+              f"{32 * throughput(local.retrieve_many, batches, 1, seconds):>10.0f}")
+        print(f"{'daemon retrieve_many/32':<28} {1:>7} "
+              f"{32 * throughput(client.retrieve_many, batches, 1, seconds):>10.0f}")
+        client.close()
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 3.0, sys.argv[2] if len(sys.argv) > 2 else "data")
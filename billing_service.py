@@ -1,13 +1,31 @@
 import json
 import os
+import base64
+import bisect
+import threading
 from datetime import datetime, timedelta
 import random
+from profiling import span
+
+PAYMENT_PAGE_SIZE = 20
+PAYMENT_PAGE_MAX = 100
+DUE_WINDOW_MAX_DAYS = 366
 
 class BillingService:
     def __init__(self, data_dir="data"):
         self.data_dir = data_dir
         self.bills_file = os.path.join(data_dir, "user_bills.json")
         self.payments_file = os.path.join(data_dir, "payment_history.json")
+
+        # In-memory bills plus materialized views, reloaded when the file changes on disk
+        self._lock = threading.RLock()
+        self._bills = {}
+        self._bills_mtime = None
+        self._aggregates = {}   # mobile -> total_due, pending_count, latest_plan, name
+        self._due_index = []    # sorted (due_date, mobile, bill_id) for pending bills
+        self._payments = {}     # mobile -> payments sorted oldest first
+        self._payment_keys = {} # mobile -> sorted (payment_date, transaction_id, payment_id), parallel to _payments
+        self._payments_mtime = None
         
         # Initialize data files if they don't exist
         if not os.path.exists(self.bills_file):
@@ -79,12 +97,38 @@ class BillingService:
         with open(self.payments_file, 'w') as f:
             json.dump(sample_payments, f, indent=2)
     
+    def _ensure_bills_loaded(self):
+        """(Re)load bills and rebuild aggregates and the due-date index if the file changed"""
+        mtime = os.path.getmtime(self.bills_file)
+        if mtime == self._bills_mtime:
+            return
+        with span("billing.load_bills"), open(self.bills_file, 'r') as f:
+            all_bills = json.load(f)
+        self._bills = all_bills
+        self._aggregates = {mobile: self._compute_aggregate(bills) for mobile, bills in all_bills.items()}
+        self._due_index = sorted(
+            (b['due_date'], mobile, b['bill_id'])
+            for mobile, bills in all_bills.items() for b in bills if b['status'] == 'pending'
+        )
+        self._bills_mtime = mtime
+
+    @staticmethod
+    def _compute_aggregate(bills):
+        pending = [b for b in bills if b['status'] == 'pending']
+        latest = max(bills, key=lambda b: b['due_date']) if bills else None
+        return {
+            "total_due": sum(b['amount'] for b in pending),
+            "pending_count": len(pending),
+            "latest_plan": latest['plan'] if latest else None,
+            "name": latest['name'] if latest else None
+        }
+
     def get_bills(self, mobile):
         """Get all bills for a mobile number"""
         try:
-            with open(self.bills_file, 'r') as f:
-                all_bills = json.load(f)
-            return all_bills.get(mobile, [])
+            with self._lock:
+                self._ensure_bills_loaded()
+                return list(self._bills.get(mobile, []))
         except Exception as e:
             print(f"Error loading bills: {e}")
             return []
@@ -93,69 +137,162 @@ class BillingService:
         """Get pending bills for a mobile number"""
         bills = self.get_bills(mobile)
         return [b for b in bills if b['status'] == 'pending']
+
+    def get_account_summary(self, mobile):
+        """Get materialized aggregates (total_due, pending_count, latest_plan, name) for a mobile number"""
+        try:
+            with self._lock:
+                self._ensure_bills_loaded()
+                aggregate = self._aggregates.get(mobile)
+                return dict(aggregate) if aggregate else None
+        except Exception as e:
+            print(f"Error loading bills: {e}")
+            return None
+
+    def get_total_due(self, mobile):
+        summary = self.get_account_summary(mobile)
+        return summary["total_due"] if summary else 0
+
+    def get_due_bills(self, within_days, today=None):
+        """Pending bills due between today and today + within_days (inclusive), soonest first.
+
+        Uses the sorted due-date index, so the cost is a binary search plus the size of the result.
+        """
+        today = today or datetime.now().date()
+        start = today.strftime("%Y-%m-%d")
+        end = (today + timedelta(days=within_days)).strftime("%Y-%m-%d")
+        try:
+            with span("billing.due_bills", within_days=within_days), self._lock:
+                self._ensure_bills_loaded()
+                lo = bisect.bisect_left(self._due_index, (start,))
+                hi = bisect.bisect_right(self._due_index, (end, chr(0x10FFFF)))
+                due = []
+                for due_date, mobile, bill_id in self._due_index[lo:hi]:
+                    bill = next(b for b in self._bills[mobile] if b['bill_id'] == bill_id)
+                    due.append({
+                        "mobile": mobile,
+                        "name": bill['name'],
+                        "bill_id": bill_id,
+                        "amount": bill['amount'],
+                        "due_date": due_date
+                    })
+                return due
+        except Exception as e:
+            print(f"Error loading bills: {e}")
+            return []
     
     def get_bill_summary(self, mobile):
         """Get bill summary for AI to use"""
-        bills = self.get_bills(mobile)
-        pending = [b for b in bills if b['status'] == 'pending']
+        with span("billing.bill_summary"):
+            aggregate = self.get_account_summary(mobile)
         
-        if not bills:
-            return f"No billing information found for mobile number {mobile}."
+            if not aggregate:
+                return f"No billing information found for mobile number {mobile}."
         
-        summary = f"Billing Summary for {mobile}:\n"
-        summary += f"Customer Name: {bills[0]['name']}\n"
-        summary += f"Current Plan: {bills[0]['plan']}\n\n"
+            summary = f"Billing Summary for {mobile}:\n"
+            summary += f"Customer Name: {aggregate['name']}\n"
+            summary += f"Current Plan: {aggregate['latest_plan']}\n\n"
         
-        if pending:
-            summary += "PENDING BILLS:\n"
-            for bill in pending:
-                summary += f"- Bill ID: {bill['bill_id']}\n"
-                summary += f"  Amount: ₹{bill['amount']}\n"
-                summary += f"  Due Date: {bill['due_date']}\n"
-                summary += f"  Period: {bill['billing_period']}\n\n"
+            if aggregate['pending_count']:
+                summary += "PENDING BILLS:\n"
+                for bill in self.get_pending_bills(mobile):
+                    summary += f"- Bill ID: {bill['bill_id']}\n"
+                    summary += f"  Amount: ₹{bill['amount']}\n"
+                    summary += f"  Due Date: {bill['due_date']}\n"
+                    summary += f"  Period: {bill['billing_period']}\n\n"
             
-            total_due = sum(b['amount'] for b in pending)
-            summary += f"Total Amount Due: ₹{total_due}\n"
-        else:
-            summary += "No pending bills. All bills are paid.\n"
+                summary += f"Total Amount Due: ₹{aggregate['total_due']}\n"
+            else:
+                summary += "No pending bills. All bills are paid.\n"
         
-        return summary
+            return summary
     
+    @staticmethod
+    def _payment_key(payment):
+        return (payment.get('payment_date', ''), payment.get('transaction_id', ''), payment.get('payment_id', ''))
+
+    def _ensure_payments_loaded(self):
+        """(Re)load payments into per-subscriber, time-ordered lists if the file changed"""
+        mtime = os.path.getmtime(self.payments_file)
+        if mtime == self._payments_mtime:
+            return
+        with span("billing.load_payments"), open(self.payments_file, 'r') as f:
+            all_payments = json.load(f)
+        self._payments = {}
+        self._payment_keys = {}
+        for mobile, payments in all_payments.items():
+            payments = sorted(payments, key=self._payment_key)
+            self._payments[mobile] = payments
+            self._payment_keys[mobile] = [self._payment_key(p) for p in payments]
+        self._payments_mtime = mtime
+
+    @staticmethod
+    def _encode_cursor(key):
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        except Exception:
+            raise ValueError("Invalid cursor")
+        if not isinstance(key, list) or len(key) != 3 or not all(isinstance(k, str) for k in key):
+            raise ValueError("Invalid cursor")
+        return tuple(key)
+
     def get_payment_history(self, mobile):
         """Get payment history for a mobile number"""
         try:
-            with open(self.payments_file, 'r') as f:
-                all_payments = json.load(f)
-            return all_payments.get(mobile, [])
+            with self._lock:
+                self._ensure_payments_loaded()
+                return list(self._payments.get(mobile, []))
         except Exception as e:
             print(f"Error loading payments: {e}")
             return []
+
+    def get_payment_page(self, mobile, since=None, until=None, limit=PAYMENT_PAGE_SIZE, cursor=None):
+        """Get one page of payments, newest first, optionally within [since, until] (YYYY-MM-DD).
+
+        Pass the returned next_cursor back to get the following (older) page. Work is a
+        binary search on the payment_date index plus the page size.
+        """
+        limit = max(1, min(limit, PAYMENT_PAGE_MAX))
+        with span("billing.payment_page"), self._lock:
+            self._ensure_payments_loaded()
+            payments = self._payments.get(mobile, [])
+            keys = self._payment_keys.get(mobile, [])
+
+            lo = bisect.bisect_left(keys, (since,)) if since else 0
+            hi = bisect.bisect_right(keys, (until, chr(0x10FFFF))) if until else len(keys)
+            if cursor:
+                hi = min(hi, bisect.bisect_left(keys, self._decode_cursor(cursor)))
+
+            start = max(lo, hi - limit)
+            page = payments[start:hi][::-1]
+            next_cursor = self._encode_cursor(keys[start]) if start > lo else None
+            return {"payments": page, "next_cursor": next_cursor}
     
     def make_payment(self, mobile, bill_id, amount, payment_method="UPI"):
         """Process a payment"""
         try:
-            # Load bills
-            with open(self.bills_file, 'r') as f:
-                all_bills = json.load(f)
-            
-            # Find and update bill
-            if mobile in all_bills:
-                for bill in all_bills[mobile]:
-                    if bill['bill_id'] == bill_id:
-                        bill['status'] = 'paid'
-                        bill['paid_date'] = datetime.now().strftime("%Y-%m-%d")
-                        break
-                
-                # Save updated bills
-                with open(self.bills_file, 'w') as f:
-                    json.dump(all_bills, f, indent=2)
-            
-            # Add payment record
-            with open(self.payments_file, 'r') as f:
-                all_payments = json.load(f)
-            
-            if mobile not in all_payments:
-                all_payments[mobile] = []
+            with self._lock:
+                self._ensure_bills_loaded()
+                all_bills = self._bills
+
+                # Find and update bill
+                if mobile in all_bills:
+                    for bill in all_bills[mobile]:
+                        if bill['bill_id'] == bill_id:
+                            if bill['status'] == 'pending':
+                                self._settle_pending(mobile, bill)
+                            bill['status'] = 'paid'
+                            bill['paid_date'] = datetime.now().strftime("%Y-%m-%d")
+                            break
+
+                    # Save updated bills
+                    with span("billing.write_bills"), open(self.bills_file, 'w') as f:
+                        json.dump(all_bills, f, indent=2)
+                    self._bills_mtime = os.path.getmtime(self.bills_file)
             
             payment = {
                 "payment_id": f"PAY{random.randint(1000, 9999)}",
@@ -167,10 +304,18 @@ class BillingService:
                 "status": "success"
             }
             
-            all_payments[mobile].append(payment)
-            
-            with open(self.payments_file, 'w') as f:
-                json.dump(all_payments, f, indent=2)
+            # Add payment record, keeping each subscriber's history time-ordered
+            with self._lock:
+                self._ensure_payments_loaded()
+                key = self._payment_key(payment)
+                keys = self._payment_keys.setdefault(mobile, [])
+                i = bisect.bisect_right(keys, key)
+                keys.insert(i, key)
+                self._payments.setdefault(mobile, []).insert(i, payment)
+
+                with span("billing.write_payments"), open(self.payments_file, 'w') as f:
+                    json.dump(self._payments, f, indent=2)
+                self._payments_mtime = os.path.getmtime(self.payments_file)
             
             return {
                 "success": True,
@@ -184,18 +329,28 @@ class BillingService:
                 "message": f"Payment failed: {str(e)}"
             }
     
+    def _settle_pending(self, mobile, bill):
+        """Incrementally update aggregates and the due-date index for a bill leaving 'pending'"""
+        aggregate = self._aggregates[mobile]
+        aggregate['total_due'] -= bill['amount']
+        aggregate['pending_count'] -= 1
+        i = bisect.bisect_left(self._due_index, (bill['due_date'], mobile, bill['bill_id']))
+        if i < len(self._due_index) and self._due_index[i] == (bill['due_date'], mobile, bill['bill_id']):
+            del self._due_index[i]
+    
     def search_bills(self, query):
         """Search bills based on query for RAG integration"""
-        try:
-            # Extract mobile number from query if present
-            import re
-            mobile_match = re.search(r'\b\d{10}\b', query)
+        with span("billing.search_bills"):
+            try:
+                # Extract mobile number from query if present
+                import re
+                mobile_match = re.search(r'\b\d{10}\b', query)
             
-            if mobile_match:
-                mobile = mobile_match.group()
-                return self.get_bill_summary(mobile)
-            else:
-                return "Please provide a valid 10-digit mobile number to check bills."
+                if mobile_match:
+                    mobile = mobile_match.group()
+                    return self.get_bill_summary(mobile)
+                else:
+                    return "Please provide a valid 10-digit mobile number to check bills."
         
-        except Exception as e:
-            return f"Error searching bills: {str(e)}"
+            except Exception as e:
+                return f"Error searching bills: {str(e)}"
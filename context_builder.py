@@ -0,0 +1,101 @@
+import re
+
+from text_utils import content_terms, estimate_tokens, split_sentences, shingles, jaccard
+
+FIELD_RE = re.compile(r"^([^:\n]{1,40}):\s")
+
+
+def legacy_context_tokens(retrieved, max_docs, max_chars):
+    """Token estimate of the old packing (top max_docs, whole texts, up to max_chars)"""
+    blocks = []
+    curr_len = 0
+    for idx, r in enumerate(retrieved[:max_docs]):
+        block = f"[{idx+1}]\n{r['text']}\n"
+        if curr_len + len(block) > max_chars:
+            break
+        blocks.append(block)
+        curr_len += len(block)
+    return estimate_tokens("\n".join(blocks)) if blocks else 0
+
+
+def trim_to_relevant(text, query_terms, max_sentences, max_tokens, keep_fields=()):
+    """Cut a doc to at most max_tokens, keeping the sentences sharing most terms with the query.
+
+    Each line is split into sentences, except `field: value` lines whose field
+    name contains one of keep_fields (e.g. "solution"): those are kept whole,
+    as are docs already within max_tokens. Original order is preserved.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    units = []   # (line index, text, pinned)
+    for n, line in enumerate(text.split("\n")):
+        field = FIELD_RE.match(line)
+        if field and any(k in field.group(1).lower() for k in keep_fields):
+            units.append((n, line, True))
+        else:
+            units.extend((n, sentence, False) for sentence in split_sentences(line))
+
+    keep = {i for i, (_, _, pinned) in enumerate(units) if pinned}
+    budget = max_tokens - sum(estimate_tokens(units[i][1]) for i in keep)
+    ranked = sorted((i for i in range(len(units)) if i not in keep),
+                    key=lambda i: (-len(query_terms & set(content_terms(units[i][1]))), i))
+    for i in ranked[:max_sentences]:
+        cost = estimate_tokens(units[i][1])
+        if cost <= budget:
+            keep.add(i)
+            budget -= cost
+
+    lines = {}
+    for i in sorted(keep):
+        n, unit, _ = units[i]
+        lines[n] = f"{lines[n]} {unit}" if n in lines else unit
+    return "\n".join(lines[n] for n in sorted(lines))
+
+
+def build_context(query, retrieved, max_docs, max_tokens, dedup_threshold, max_sentences, max_chars,
+                  keep_fields=()):
+    """Pack retrieved docs into a numbered context block within a token budget.
+
+    Docs are taken in relevance order; a doc whose shingle set is at least
+    dedup_threshold similar (Jaccard) to an already packed doc is dropped. A
+    doc larger than its share of the budget (max_tokens / max_docs) or than
+    the budget left is trimmed to its most query-relevant sentences, keeping
+    keep_fields lines whole.
+
+    Returns (context, used_docs, stats) where used_docs[i] is cited as [i+1].
+    """
+    query_terms = set(content_terms(query))
+    doc_share = max_tokens // max_docs if max_docs else max_tokens
+    kept_shingles = []
+    used = []
+    parts = []
+    tokens = 0
+    duplicates = 0
+
+    for r in retrieved:
+        if len(used) >= max_docs:
+            break
+        sh = shingles(r["text"])
+        if any(jaccard(sh, other) >= dedup_threshold for other in kept_shingles):
+            duplicates += 1
+            continue
+
+        limit = min(doc_share, max_tokens - tokens)
+        block = f"[{len(used)+1}]\n{trim_to_relevant(r['text'], query_terms, max_sentences, limit, keep_fields)}\n"
+        block_tokens = estimate_tokens(block)
+        if tokens + block_tokens > max_tokens:
+            break
+        kept_shingles.append(sh)
+        used.append(r)
+        parts.append(block)
+        tokens += block_tokens
+
+    baseline = legacy_context_tokens(retrieved, max_docs, max_chars)
+    stats = {
+        "context_tokens": tokens,
+        "baseline_tokens": baseline,
+        "tokens_saved": max(baseline - tokens, 0),
+        "duplicates_removed": duplicates,
+    }
+    return "\n".join(parts), used, stats
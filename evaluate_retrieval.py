@@ -0,0 +1,198 @@
+"""Offline retrieval quality vs. latency evaluation.
+
+Usage:
+    python evaluate_retrieval.py [data_dir]
+
+AgentAssignedTopic in CustomerInteractionData.csv is used as a weak relevance
+label: every interaction is sent as a query and the other interactions with
+the same topic are its relevant documents. The query's own row (and the hit
+it was collapsed into, when dedup is on) is left out of the ranking.
+
+For each configuration in benchmark_index.CONFIGS the report shows recall@k
+(relevant rows found in the top k, over min(k, relevant rows)), MRR, the
+escalation rate (top score below SIMILARITY_THRESHOLD), per-query latency and
+index memory. Configurations on the Pareto front of MRR vs. p50 latency vs.
+memory are starred. A threshold sweep for the first configuration follows,
+then the same queries with synthetic typos, with and without typo correction.
+"""
+import os
+import re
+import sys
+import random
+import time
+import tempfile
+import tracemalloc
+
+import pandas as pd
+
+from rag_service import RAGService, FINAL_K, TOP_K_RETRIEVE, SIMILARITY_THRESHOLD
+from benchmark_index import CONFIGS, quiet
+
+LABEL_FILE = "CustomerInteractionData.csv"
+TEXT_COLUMN = "CustomerInteractionRawText"
+LABEL_COLUMN = "AgentAssignedTopic"
+K_VALUES = sorted({1, 3, FINAL_K, TOP_K_RETRIEVE})
+THRESHOLD_SWEEP = [0.05, 0.1, 0.15, 0.2, 0.3]
+TYPO_CONFIG = {"vectorizer_mode": "tfidf", "dtype": "float32"}
+TYPO_RATE = 0.5   # Share of words of 6+ letters that get two adjacent letters swapped
+TYPO_SEED = 7
+
+
+def load_cases(data_dir):
+    """(source_id, query text, topic) for every labelled interaction"""
+    path = os.path.join(data_dir, LABEL_FILE)
+    df = pd.read_csv(path, usecols=[TEXT_COLUMN, LABEL_COLUMN])
+    cases = []
+    for idx, text, topic in zip(df.index, df[TEXT_COLUMN], df[LABEL_COLUMN]):
+        if isinstance(text, str) and isinstance(topic, str) and text.strip():
+            cases.append((f"{LABEL_FILE}::row_{idx}", text, topic.strip()))
+    return cases
+
+
+def add_typos(cases, rate=TYPO_RATE, seed=TYPO_SEED):
+    """Same cases with adjacent letters swapped inside some of the longer words"""
+    rng = random.Random(seed)
+
+    def swap(match):
+        word = match.group(0)
+        if rng.random() >= rate:
+            return word
+        i = rng.randrange(1, len(word) - 2)
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+    return [(source_id, re.sub(r"[A-Za-z]{6,}", swap, text), topic) for source_id, text, topic in cases]
+
+
+def evaluate(rag, cases):
+    """Run every case through rag.retrieve; returns per-query judgements and latencies"""
+    labels = {source_id: topic for source_id, _, topic in cases}
+    relevant_counts = {}
+    for topic in labels.values():
+        relevant_counts[topic] = relevant_counts.get(topic, 0) + 1
+
+    # A representative stands in for the rows collapsed into it
+    members = {d["source_id"]: [d["source_id"]] + d.get("duplicate_source_ids", []) for d in rag.metadata}
+
+    if cases:
+        rag.retrieve(cases[0][1])  # Warm up so the first timed query doesn't pay one-off costs
+
+    judged = []
+    latencies = []
+    for source_id, text, topic in cases:
+        start = time.perf_counter()
+        hits = rag.retrieve(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        ranked = []
+        for hit in hits:
+            rows = members[hit["source_id"]]
+            if source_id in rows:
+                continue
+            ranked.append((hit["score"], sum(1 for m in rows if labels.get(m) == topic)))
+        judged.append({
+            "top_score": ranked[0][0] if ranked else 0.0,
+            "relevant_per_hit": [n for _, n in ranked],
+            "relevant_total": relevant_counts[topic] - 1,
+        })
+    return judged, latencies
+
+
+def summarize(judged, latencies, threshold=SIMILARITY_THRESHOLD):
+    stats = {}
+    for k in K_VALUES:
+        scores = [min(sum(q["relevant_per_hit"][:k]), k) / min(k, q["relevant_total"])
+                  for q in judged if q["relevant_total"]]
+        stats[f"recall@{k}"] = sum(scores) / len(scores) if scores else 0.0
+
+    reciprocal_ranks = []
+    for q in judged:
+        rank = next((i + 1 for i, n in enumerate(q["relevant_per_hit"]) if n), None)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    stats["mrr"] = sum(reciprocal_ranks) / len(reciprocal_ranks) if reciprocal_ranks else 0.0
+    stats["escalation"] = sum(q["top_score"] < threshold for q in judged) / len(judged) if judged else 0.0
+
+    latencies = sorted(latencies)
+    stats["p50_ms"] = latencies[len(latencies) // 2]
+    stats["p95_ms"] = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+    return stats
+
+
+def run_config(data_dir, options, cases, tmp_dir, name):
+    index_path = os.path.join(tmp_dir, f"{name}.pkl")
+    quiet(RAGService, data_dir=data_dir, index_path=index_path, **options)
+
+    tracemalloc.start()
+    rag = quiet(RAGService, data_dir=data_dir, index_path=index_path, **options)
+    _, load_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    judged, latencies = evaluate(rag, cases)
+    stats = summarize(judged, latencies)
+    stats.update({
+        "docs": len(rag.metadata),
+        "matrix_bytes": rag.index_size_bytes(),
+        "load_peak_bytes": load_peak,
+        "judged": judged,
+    })
+    return stats
+
+
+def pareto_front(rows):
+    """Names of configs no other config beats on MRR, p50 latency and matrix memory at once"""
+    front = set()
+    for name, s in rows:
+        dominated = any(
+            o["mrr"] >= s["mrr"] and o["p50_ms"] <= s["p50_ms"] and o["matrix_bytes"] <= s["matrix_bytes"]
+            and (o["mrr"] > s["mrr"] or o["p50_ms"] < s["p50_ms"] or o["matrix_bytes"] < s["matrix_bytes"])
+            for other, o in rows if other != name
+        )
+        if not dominated:
+            front.add(name)
+    return front
+
+
+def main(data_dir="data"):
+    cases = load_cases(data_dir)
+    print(f"Evaluating {len(CONFIGS)} configurations on {len(cases)} labelled queries "
+          f"({len({c[2] for c in cases})} topics)\n")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rows = [(name, run_config(data_dir, options, cases, tmp_dir, f"config_{i}"))
+                for i, (name, options) in enumerate(CONFIGS)]
+    front = pareto_front(rows)
+
+    recall_cols = "".join(f" {'R@' + str(k):>6}" for k in K_VALUES)
+    header = (f"  {'config':<32} {'docs':>5}{recall_cols} {'MRR':>6} {'escal.':>7} "
+              f"{'p50 ms':>7} {'p95 ms':>7} {'matrix KB':>10} {'load KB':>8}")
+    print(header)
+    print("-" * len(header))
+    for name, s in rows:
+        recalls = "".join(f" {s[f'recall@{k}']:>6.3f}" for k in K_VALUES)
+        print(f"{'*' if name in front else ' '} {name:<32} {s['docs']:>5}{recalls} {s['mrr']:>6.3f} "
+              f"{s['escalation']:>7.1%} {s['p50_ms']:>7.3f} {s['p95_ms']:>7.3f} "
+              f"{s['matrix_bytes'] / 1024:>10.1f} {s['load_peak_bytes'] / 1024:>8.1f}")
+    print("\n* Pareto-optimal on MRR / p50 latency / matrix memory")
+
+    name, s = rows[0]
+    print(f"\nEscalation vs. SIMILARITY_THRESHOLD ({name}; current {SIMILARITY_THRESHOLD}):")
+    print(f"  {'threshold':>9} {'escal.':>7} {'top-1 on-topic when answered':>29}")
+    for threshold in THRESHOLD_SWEEP:
+        answered = [q for q in s["judged"] if q["top_score"] >= threshold]
+        on_topic = sum(1 for q in answered if q["relevant_per_hit"][:1] and q["relevant_per_hit"][0])
+        rate = on_topic / len(answered) if answered else 0.0
+        print(f"  {threshold:>9.2f} {1 - len(answered) / len(s['judged']):>7.1%} {rate:>29.1%}")
+
+    typo_cases = add_typos(cases)
+    print(f"\nSynthetic typos ({TYPO_RATE:.0%} of words with 6+ letters get a transposition):")
+    print(f"  {'queries':<9} {'correction':<11} {'R@' + str(FINAL_K):>6} {'MRR':>6} {'escal.':>7} {'p50 ms':>7}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for label, query_cases in (("clean", cases), ("typos", typo_cases)):
+            for spell_correct in (False, True):
+                s = run_config(data_dir, dict(TYPO_CONFIG, spell_correct=spell_correct), query_cases,
+                               tmp_dir, "typos")
+                print(f"  {label:<9} {'on' if spell_correct else 'off':<11} {s[f'recall@{FINAL_K}']:>6.3f} "
+                      f"{s['mrr']:>6.3f} {s['escalation']:>7.1%} {s['p50_ms']:>7.3f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "data")
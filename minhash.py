@@ -0,0 +1,60 @@
+import zlib
+import numpy as np
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+class MinHasher:
+    """MinHash signatures over sets of strings (estimates Jaccard similarity)"""
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, _MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MAX_HASH, size=num_perm, dtype=np.uint64)
+
+    def signature(self, items):
+        if not items:
+            return None
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in items), dtype=np.uint64, count=len(items))
+        # (a * h + b) mod p stays below 2**64 because a, b and h are 32-bit
+        permuted = (hashes[:, None] * self.a + self.b) % _MERSENNE_PRIME
+        return permuted.min(axis=0)
+
+    @staticmethod
+    def similarity(sig1, sig2):
+        return float(np.mean(sig1 == sig2))
+
+
+class LSHIndex:
+    """Banded LSH over MinHash signatures: keys sharing any band are candidates"""
+
+    def __init__(self, num_perm=64, bands=32):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = {}
+
+    def _band_keys(self, sig):
+        for band in range(self.bands):
+            yield band, sig[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def insert(self, key, sig):
+        for band_key in self._band_keys(sig):
+            self.buckets.setdefault(band_key, set()).add(key)
+
+    def remove(self, key, sig):
+        for band_key in self._band_keys(sig):
+            bucket = self.buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band_key]
+
+    def candidates(self, sig):
+        found = set()
+        for band_key in self._band_keys(sig):
+            found.update(self.buckets.get(band_key, ()))
+        return found
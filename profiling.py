@@ -0,0 +1,159 @@
+"""Opt-in diagnostics: a sampling profiler over all live threads and
+per-request span tracing propagated through the services via contextvars.
+"""
+import os
+import sys
+import time
+import uuid
+import threading
+import contextvars
+from collections import Counter, OrderedDict
+
+MAX_PROFILE_SECONDS = 60
+MAX_STACK_DEPTH = 64
+MAX_RECENT_TRACES = 200
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+_recent_traces = OrderedDict()
+_traces_lock = threading.Lock()
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is already running"""
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(seconds, interval=0.005):
+    """Sample every other thread's stack each `interval` seconds for `seconds`.
+
+    Returns a Counter of collapsed stacks ("root;...;leaf" -> samples).
+    Only one profile runs at a time; a concurrent call raises ProfilerBusy.
+    """
+    seconds = min(seconds, MAX_PROFILE_SECONDS)
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusy("A profile is already running")
+    try:
+        own = threading.get_ident()
+        stacks = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                labels = []
+                while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                stacks[";".join(reversed(labels))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _profile_lock.release()
+
+
+def format_collapsed(stacks):
+    """Brendan Gregg collapsed format, ready for flamegraph.pl / speedscope"""
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.spans = []
+        self.attrs = {}
+
+    def to_dict(self):
+        return {"trace_id": self.trace_id, "attrs": self.attrs, "spans": self.spans}
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "span_id", "parent_id", "start", "token")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = _current_span.get()
+        self.token = _current_span.set(self.span_id)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        _current_span.reset(self.token)
+        record = {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - self.trace.started) * 1000, 3),
+            "duration_ms": round((end - self.start) * 1000, 3),
+        }
+        if self.attrs:
+            record["attrs"] = self.attrs
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        self.trace.spans.append(record)
+        return False
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name, **attrs):
+    """Time a block as a child of the current span; a no-op unless a trace is active"""
+    trace = _current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return _Span(trace, name, attrs)
+
+
+def start_trace(**attrs):
+    """Begin tracing the current request under a new trace ID; returns (trace, token) for finish_trace"""
+    trace = Trace()
+    trace.attrs.update(attrs)
+    return trace, _current_trace.set(trace)
+
+
+def finish_trace(trace, token):
+    """Stop tracing and keep the trace among the most recent ones"""
+    _current_trace.reset(token)
+    trace.attrs["duration_ms"] = round((time.perf_counter() - trace.started) * 1000, 3)
+    with _traces_lock:
+        _recent_traces[trace.trace_id] = trace
+        while len(_recent_traces) > MAX_RECENT_TRACES:
+            _recent_traces.popitem(last=False)
+
+
+def current_trace_id():
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+def get_trace(trace_id):
+    with _traces_lock:
+        trace = _recent_traces.get(trace_id)
+    return trace.to_dict() if trace else None
+
+
+def recent_traces():
+    with _traces_lock:
+        return [{"trace_id": t.trace_id, **t.attrs} for t in reversed(_recent_traces.values())]
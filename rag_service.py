@@ -3,34 +3,151 @@ import re
 import json
 import time
 import pickle
+import hashlib
+import threading
 import requests
 import numpy as np
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, HashingVectorizer, TfidfTransformer
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.pipeline import make_pipeline
+from request_coalescing import SingleFlight, ConcurrencyLimiter, UpstreamBusy
+from context_builder import build_context
+from answer_cache import SemanticAnswerCache
+from minhash import MinHasher, LSHIndex
+from text_utils import shingles, jaccard
+from retrieval_server import RetrievalClient
+from profiling import span
+from spelling import SpellCorrector
 
 # Configuration
 TOP_K_RETRIEVE = 10
 FINAL_K = 5
+FOLLOW_UP_FINAL_K = 3 # Follow-ups lean on the conversation summary, so fewer docs go in the prompt
 SIMILARITY_THRESHOLD = 0.1 # Lower threshold for TF-IDF
 MAX_CONTEXT_CHARS = 6000
+MAX_CONTEXT_TOKENS = MAX_CONTEXT_CHARS // 4
+NEAR_DUPLICATE_THRESHOLD = 0.6 # Shingle Jaccard above which a retrieved doc is left out of the prompt
+MAX_SENTENCES_PER_DOC = 3      # Docs over their share of the budget keep this many query-relevant sentences
 PERPLEXITY_MODEL = "sonar"
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+
+# Upstream protection
+UPSTREAM_MAX_CONCURRENCY = 8   # Max simultaneous Perplexity requests
+UPSTREAM_MAX_QUEUE = 32        # Requests allowed to wait for a slot before failing fast
+UPSTREAM_QUEUE_TIMEOUT = 5.0   # Seconds a queued request waits for a slot
+
+# Index build options
+VECTORIZER_MODE = "tfidf"      # "tfidf" (vocabulary dict) or "hashing" (stateless, no vocabulary)
+INDEX_DTYPE = "float32"        # "float32" halves matrix memory vs "float64"
+MIN_DF = 1                     # Drop terms seen in fewer documents (prunes typos / one-offs)
+MAX_FEATURES = None            # Cap vocabulary to the most frequent terms
+HASHING_N_FEATURES = 2 ** 16   # Hash space for "hashing" mode (IDF vector is stored densely)
+DEDUP_ENABLED = True           # Collapse near-duplicate rows into one representative document
+DEDUP_THRESHOLD = 0.8          # Word-shingle Jaccard at which two rows count as duplicates
+DUPLICATE_BOOST = 0.0          # Score multiplier 1 + boost * log(duplicate_count); 0 disables
+INDEX_FORMAT_VERSION = 3       # Bump when the pickled index layout changes
+
+# Schema inference
+SCHEMA_MANIFEST_FILE = "schema_manifest.json"  # Per-file text/extra columns, reused while the file hash matches
+SCHEMA_SAMPLE_ROWS = 500       # Rows sampled to infer a file's schema
+TEXT_COLUMN_CANDIDATES = ["conversation", "text", "dialogue", "issue", "description", "ticket_text", "content"]
+EXTRA_COLUMN_KEYWORDS = ["title", "summary", "solution", "answer", "reply", "topic", "desc"]
+
+# Metadata pre-filtering
+FILTER_COLUMNS = ["AgentAssignedTopic", "LocationID", "AgentID"]
+SHARD_BY = None                # e.g. "AgentAssignedTopic" to keep one sub-matrix per topic
+
+# Fast path: answer straight from a document's solution fields, skipping the LLM
+FAST_PATH_ENABLED = True
+FAST_PATH_MIN_SCORE = 0.45     # Top hit must be at least this similar
+FAST_PATH_MIN_MARGIN = 0.2     # ...and this far ahead of the second hit
+SOLUTION_COLUMN_KEYWORDS = ["solution", "answer", "reply"]
+
+# Retrieval server (see retrieval_server.py)
+REMOTE_RETRY_SECONDS = 30      # After a server failure, serve in-process for this long before retrying
+
+# Query typo correction against the index vocabulary (see spelling.py)
+SPELL_CORRECTION_ENABLED = True
+SPELL_MAX_EDIT_DISTANCE = 2
+SPELL_CACHE_SIZE = 4096
+
+# Semantic answer cache (paraphrased queries with the same retrieved sources)
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_SIMILARITY = 0.5      # Estimated Jaccard of query character shingles
+ANSWER_CACHE_SOURCE_OVERLAP = 0.6  # Jaccard of the top FINAL_K source ids
+ANSWER_CACHE_MAX_ENTRIES = 2048
 
 class RAGService:
-    def __init__(self, data_dir="data"):
+    def __init__(self, data_dir="data", vectorizer_mode=VECTORIZER_MODE, dtype=INDEX_DTYPE,
+                 min_df=MIN_DF, max_features=MAX_FEATURES, index_path=None, shard_by=SHARD_BY,
+                 dedup=DEDUP_ENABLED, schema=None, retrieval_server=None,
+                 spell_correct=SPELL_CORRECTION_ENABLED):
         self.data_dir = data_dir
         self.vectorizer = None
         self.tfidf_matrix = None
         self.metadata = []
+        self.facets = {}   # column -> value -> sorted row indices
+        self.shard_by = shard_by
+        self.shards = {}   # shard value -> (row indices, sub-matrix)
+        self.index_stats = {}
+        self._score_boost = None
+        self._source_rows = {}
+        self.spell_correct = spell_correct
+        self.speller = None
         self.perplexity_api_key = os.environ.get("PERPLEXITY_API_KEY")
+
+        self._metrics_lock = threading.Lock()
+        self.metrics = {"queries": 0, "fast_path": 0, "cache": 0, "llm": 0, "retrieval_only": 0,
+                        "context_tokens": 0, "context_tokens_saved": 0}
+
+        self.answer_cache = SemanticAnswerCache(threshold=ANSWER_CACHE_SIMILARITY,
+                                                min_source_overlap=ANSWER_CACHE_SOURCE_OVERLAP,
+                                                max_entries=ANSWER_CACHE_MAX_ENTRIES)
+
+        # Identical concurrent prompts share one upstream call
+        self._inflight = SingleFlight()
+        self._upstream_limiter = ConcurrencyLimiter(UPSTREAM_MAX_CONCURRENCY, UPSTREAM_MAX_QUEUE,
+                                                    UPSTREAM_QUEUE_TIMEOUT)
+
+        if vectorizer_mode not in ("tfidf", "hashing"):
+            raise ValueError(f"Unknown vectorizer_mode: {vectorizer_mode}")
+        self.index_options = {
+            "version": INDEX_FORMAT_VERSION,
+            "vectorizer_mode": vectorizer_mode,
+            "dtype": dtype,
+            "min_df": min_df,
+            "max_features": max_features,
+            "dedup": dedup,
+            "dedup_threshold": DEDUP_THRESHOLD if dedup else None,
+            "schema": schema,
+        }
+        # Pinned per-file schemas: {filename: {"text_column": ..., "extra_columns": [...]}}
+        self.pinned_schema = schema or {}
+        self.index_path = index_path or os.path.join(self.data_dir, "tfidf_index.pkl")
+        # Generated alongside the index it was built for, not necessarily in data_dir
+        self.schema_manifest_path = os.path.join(os.path.dirname(os.path.abspath(self.index_path)),
+                                                 SCHEMA_MANIFEST_FILE)
         
-        self.index_path = os.path.join(self.data_dir, "tfidf_index.pkl")
+        # Optional shared retrieval daemon; the in-process index is only loaded as a fallback
+        self.retrieval_client = RetrievalClient(retrieval_server) if retrieval_server else None
+        self._remote_retry_at = 0.0
+        self._local_index_lock = threading.Lock()
+        self._local_index_ready = False
         
         # Initialize
-        if os.path.exists(self.index_path):
-            self.load_index()
-        else:
-            self.build_index()
+        if self.retrieval_client is None:
+            self._ensure_local_index()
+
+    def _ensure_local_index(self):
+        with self._local_index_lock:
+            if self._local_index_ready:
+                return
+            if os.path.exists(self.index_path):
+                self.load_index()
+            else:
+                self.build_index()
+            self._local_index_ready = True
 
     def clean_text(self, s):
         if not isinstance(s, str):
@@ -46,66 +163,78 @@ class RAGService:
             return
 
         documents = []
+        manifest = self._load_schema_manifest()
 
         for f in os.listdir(self.data_dir):
+            if f == SCHEMA_MANIFEST_FILE or not f.endswith((".csv", ".json")):
+                continue
             path = os.path.join(self.data_dir, f)
-            df = None
-            
-            if f.endswith(".csv"):
-                try:
-                    df = pd.read_csv(path)
-                except Exception as e:
-                    print(f"Error reading {f}: {e}")
-            elif f.endswith(".json"):
-                try:
-                    df = pd.read_json(path, lines=True)
-                except Exception as e:
-                    print(f"Error reading {f}: {e}")
-            
-            if df is not None and not df.empty:
-                df["_source_file"] = f
-                
-                # Detect text column specifically for this file
-                text_column = self._auto_detect_text_column(df)
-                if not text_column:
-                    print(f"Skipping {f}: No text column detected.")
+
+            try:
+                schema = self._resolve_schema(f, path, manifest)
+            except Exception as e:
+                print(f"Error reading {f}: {e}")
+                continue
+            if schema is None:
+                continue
+            text_column = schema["text_column"]
+            extra_columns = schema["extra_columns"]
+
+            try:
+                df = self._read_data_file(path, usecols=schema["usecols"])
+            except Exception as e:
+                print(f"Error reading {f}: {e}")
+                continue
+            if df.empty:
+                continue
+            df["_source_file"] = f
+
+            print(f"Processing {f}: using column '{text_column}'")
+
+            for idx, row in zip(df.index, df.to_dict("records")):
+                text = self.clean_text(str(row.get(text_column, "")))
+                if len(text) < 5:
                     continue
-                
-                print(f"Processing {f}: using column '{text_column}'")
-                
-                for idx, row in df.iterrows():
-                    text = self.clean_text(str(row.get(text_column, "")))
-                    if len(text) < 5: 
-                        continue
-                    
-                    # Combine other potentially useful columns
-                    extra = []
-                    for col in df.columns:
-                        if col == text_column or col == "_source_file":
-                            continue
-                        if any(k in col.lower() for k in ["title", "summary", "solution", "answer", "reply", "topic", "desc"]):
-                            val = self.clean_text(str(row.get(col, "")))
-                            if val and len(val) > 3:
-                                extra.append(f"{col}: {val}")
-                    
-                    full_text = text
-                    if extra:
-                        full_text = f"Issue: {text}\n" + "\n".join(extra)
-
-                    documents.append({
-                        "source_id": f"{f}::row_{idx}",
-                        "text": full_text,
-                        "meta": row.to_dict()
-                    })
+
+                # Combine other potentially useful columns
+                extra = []
+                solution = []
+                for col in extra_columns:
+                    val = self.clean_text(str(row.get(col, "")))
+                    if val and len(val) > 3:
+                        extra.append(f"{col}: {val}")
+                        if any(k in col.lower() for k in SOLUTION_COLUMN_KEYWORDS):
+                            solution.append(val)
+
+                full_text = text
+                if extra:
+                    full_text = f"Issue: {text}\n" + "\n".join(extra)
+
+                doc = {
+                    "source_id": f"{f}::row_{idx}",
+                    "text": full_text,
+                    "meta": row
+                }
+                if solution:
+                    doc["title"] = text
+                    doc["solution"] = "\n\n".join(solution)
+                documents.append(doc)
+
+        self._save_schema_manifest(manifest)
 
         if not documents:
             print("No documents found to index.")
             return
 
+        self.index_stats = {"rows": len(documents)}
+        if self.index_options["dedup"]:
+            documents = self._collapse_near_duplicates(documents)
+        self.index_stats["documents"] = len(documents)
+
         print(f"Indexing {len(documents)} documents using TF-IDF...")
         texts = [d["text"] for d in documents]
         
-        self.vectorizer = TfidfVectorizer(stop_words='english')
+        self.vectorizer = self._make_vectorizer()
         self.tfidf_matrix = self.vectorizer.fit_transform(texts)
         self.metadata = documents
         
@@ -113,11 +242,15 @@ class RAGService:
         print("Saving index to cache...")
         with open(self.index_path, "wb") as f:
             pickle.dump({
+                "options": self.index_options,
                 "vectorizer": self.vectorizer,
                 "matrix": self.tfidf_matrix,
-                "metadata": self.metadata
-            }, f)
-            
+                "metadata": self.metadata,
+                "stats": self.index_stats
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self._build_facets()
+        self._build_speller()
         print(f"Index built and saved with {len(documents)} documents.")
 
     def load_index(self):
@@ -125,20 +258,163 @@ class RAGService:
         try:
             with open(self.index_path, "rb") as f:
                 data = pickle.load(f)
+                if data.get("options") != self.index_options:
+                    print("Cached index was built with different options. Rebuilding...")
+                    self.build_index()
+                    return
                 self.vectorizer = data["vectorizer"]
                 self.tfidf_matrix = data["matrix"]
                 self.metadata = data["metadata"]
+                self.index_stats = data.get("stats", {})
+            self._build_facets()
+            self._build_speller()
             print(f"Index loaded with {len(self.metadata)} documents.")
         except Exception as e:
             print(f"Error loading cache: {e}. Rebuilding...")
             self.build_index()
 
+    def _collapse_near_duplicates(self, documents):
+        """Keep one representative per cluster of near-identical rows (same file and topic).
+
+        Candidates come from MinHash LSH over word shingles and are confirmed with
+        exact Jaccard. Representatives carry duplicate_count, the collapsed
+        source_ids, and the collapsed rows' filter values so filters still match.
+        """
+        hasher = MinHasher(num_perm=64)
+        lsh_by_group = {}
+        kept = []
+        kept_shingles = []
+
+        for doc in documents:
+            sh = shingles(doc["text"])
+            sig = hasher.signature(sh)
+            group = (doc["source_id"].split("::")[0], self._facet_value(doc["meta"].get("AgentAssignedTopic")))
+            lsh = lsh_by_group.setdefault(group, LSHIndex(num_perm=64, bands=16))
+
+            match = None
+            if sig is not None:
+                for i in sorted(lsh.candidates(sig)):
+                    if jaccard(sh, kept_shingles[i]) >= DEDUP_THRESHOLD:
+                        match = i
+                        break
+
+            if match is None:
+                if sig is not None:
+                    lsh.insert(len(kept), sig)
+                kept.append(doc)
+                kept_shingles.append(sh)
+                continue
+
+            rep_doc = kept[match]
+            rep_doc["duplicate_count"] = rep_doc.get("duplicate_count", 1) + 1
+            rep_doc.setdefault("duplicate_source_ids", []).append(doc["source_id"])
+            dup_facets = rep_doc.setdefault("duplicate_facets", {})
+            for col in FILTER_COLUMNS:
+                value = self._facet_value(doc["meta"].get(col))
+                if value is not None and value not in dup_facets.setdefault(col, []):
+                    dup_facets[col].append(value)
+
+        collapsed = len(documents) - len(kept)
+        self.index_stats["collapsed_duplicates"] = collapsed
+        print(f"Collapsed {collapsed} near-duplicate rows: {len(documents)} -> {len(kept)} documents "
+              f"({collapsed / len(documents):.1%} smaller)")
+        return kept
+
+    def _build_speller(self):
+        """Delete index over the indexed terms; the vectorizer vocabulary, when it has one, limits it"""
+        if not self.spell_correct or not self.metadata:
+            self.speller = None
+            return
+        vocabulary = getattr(self.vectorizer, "vocabulary_", None)
+        self.speller = SpellCorrector.from_texts((d["text"] for d in self.metadata), vocabulary=vocabulary,
+                                                 max_edit_distance=SPELL_MAX_EDIT_DISTANCE,
+                                                 cache_size=SPELL_CACHE_SIZE)
+
+    def _normalize_query(self, query):
+        query = self.clean_text(query)
+        if self.speller is None:
+            return query
+        with span("rag.spell_correct"):
+            return self.speller.correct(query)[0]
+
+    def _make_vectorizer(self):
+        opts = self.index_options
+        dtype = np.dtype(opts["dtype"])
+        if opts["vectorizer_mode"] == "hashing":
+            # No vocabulary dict to fit or pickle; IDF weights are learned on the hashed columns
+            return make_pipeline(
+                HashingVectorizer(stop_words='english', n_features=HASHING_N_FEATURES,
+                                  alternate_sign=False, norm=None, dtype=dtype),
+                TfidfTransformer()
+            )
+        return TfidfVectorizer(stop_words='english', dtype=dtype,
+                               min_df=opts["min_df"], max_features=opts["max_features"])
+
+    def index_size_bytes(self):
+        """Approximate in-memory size of the sparse matrix"""
+        if self.tfidf_matrix is None:
+            return 0
+        m = self.tfidf_matrix
+        return m.data.nbytes + m.indices.nbytes + m.indptr.nbytes
+
+    @staticmethod
+    def _facet_value(value):
+        """Normalize a metadata value so 8, 8.0 and "8" land in the same bucket"""
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        value = str(value).strip()
+        return value or None
+
+    def _build_facets(self):
+        """Precompute row-index arrays per filter value (and per-shard sub-matrices)"""
+        self._source_rows = {doc["source_id"]: i for i, doc in enumerate(self.metadata)}
+
+        facets = {}
+        for col in FILTER_COLUMNS:
+            buckets = {}
+            for i, doc in enumerate(self.metadata):
+                values = {self._facet_value(doc["meta"].get(col))}
+                values.update(doc.get("duplicate_facets", {}).get(col, []))
+                for value in values:
+                    if value is not None:
+                        buckets.setdefault(value, []).append(i)
+            if buckets:
+                facets[col] = {v: np.array(rows, dtype=np.int32) for v, rows in buckets.items()}
+        self.facets = facets
+
+        self._score_boost = None
+        if DUPLICATE_BOOST and any(doc.get("duplicate_count", 1) > 1 for doc in self.metadata):
+            counts = np.array([doc.get("duplicate_count", 1) for doc in self.metadata], dtype=np.float32)
+            self._score_boost = 1 + DUPLICATE_BOOST * np.log(counts)
+
+        self.shards = {}
+        if self.shard_by and self.tfidf_matrix is not None:
+            for value, rows in self.facets.get(self.shard_by, {}).items():
+                self.shards[value] = (rows, self.tfidf_matrix[rows])
+            print(f"Sharded index by {self.shard_by} into {len(self.shards)} shards.")
+
+    def _filter_rows(self, filters):
+        """Resolve {column: value or [values]} to sorted row indices (AND across columns, OR within)"""
+        rows = None
+        for col, values in filters.items():
+            if col not in self.facets:
+                raise ValueError(f"Cannot filter on '{col}'. Filterable columns: {sorted(self.facets)}")
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            buckets = self.facets[col]
+            matched = [buckets[v] for v in (self._facet_value(v) for v in values) if v in buckets]
+            col_rows = np.unique(np.concatenate(matched)) if matched else np.array([], dtype=np.int32)
+            rows = col_rows if rows is None else np.intersect1d(rows, col_rows, assume_unique=True)
+        return rows
+
     def _auto_detect_text_column(self, df):
-        candidates = ["conversation", "text", "dialogue", "issue", "description", "ticket_text", "content"]
-        for c in candidates:
+        for c in TEXT_COLUMN_CANDIDATES:
             if c in df.columns:
                 return c
-        text_like = [c for c in df.columns if df[c].dtype == object]
+        text_like = [c for c in df.columns
+                     if df[c].dtype == object or pd.api.types.is_string_dtype(df[c].dtype)]
         if not text_like:
             return None
         # choose column with largest average length
@@ -147,14 +423,95 @@ class RAGService:
             return None
         return max(avg_len, key=avg_len.get)
 
-    def retrieve(self, query):
-        if self.vectorizer is None or self.tfidf_matrix is None:
-            return []
-        
-        query_vec = self.vectorizer.transform([self.clean_text(query)])
-        
-        # Calculate Cosine Similarity
-        cosine_similarities = cosine_similarity(query_vec, self.tfidf_matrix).flatten()
+    @staticmethod
+    def _read_data_file(path, usecols=None, nrows=None):
+        if path.endswith(".csv"):
+            return pd.read_csv(path, usecols=usecols, nrows=nrows)
+        df = pd.read_json(path, lines=True, nrows=nrows)
+        return df[usecols] if usecols else df
+
+    @staticmethod
+    def _file_hash(path):
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _load_schema_manifest(self):
+        if not os.path.exists(self.schema_manifest_path):
+            return {}
+        try:
+            with open(self.schema_manifest_path, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Error loading schema manifest: {e}")
+            return {}
+
+    def _save_schema_manifest(self, manifest):
+        try:
+            with open(self.schema_manifest_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+        except Exception as e:
+            print(f"Error saving schema manifest: {e}")
+
+    def _infer_schema(self, path):
+        """Decide the text and extra columns from a bounded sample of rows"""
+        sample = self._read_data_file(path, nrows=SCHEMA_SAMPLE_ROWS)
+        if sample.empty:
+            return None
+        text_column = self._auto_detect_text_column(sample)
+        if not text_column:
+            return None
+        extra_columns = [c for c in sample.columns
+                         if c != text_column and any(k in c.lower() for k in EXTRA_COLUMN_KEYWORDS)]
+        return {"text_column": text_column, "extra_columns": extra_columns, "columns": list(sample.columns)}
+
+    def _resolve_schema(self, f, path, manifest):
+        """Pinned schema, else the manifest entry while the file hash matches, else infer and record it"""
+        schema = self.pinned_schema.get(f)
+        entry = manifest.get(f)
+        if schema is None and entry and entry.get("pinned"):
+            schema = entry
+        if schema is None:
+            file_hash = self._file_hash(path)
+            if entry and entry.get("hash") == file_hash:
+                schema = entry
+            else:
+                schema = self._infer_schema(path)
+                if schema is None:
+                    print(f"Skipping {f}: No text column detected.")
+                    manifest.pop(f, None)
+                    return None
+                manifest[f] = dict(schema, hash=file_hash)
+
+        text_column = schema["text_column"]
+        extra_columns = list(schema.get("extra_columns", []))
+        # Only read what the documents and filters need
+        usecols = [text_column] + extra_columns
+        usecols += [c for c in FILTER_COLUMNS if c not in usecols]
+        columns = schema.get("columns")
+        if columns is None:
+            columns = self._read_data_file(path, nrows=1).columns
+        usecols = [c for c in usecols if c in columns]
+        return {"text_column": text_column, "extra_columns": extra_columns, "usecols": usecols}
+
+    def _scoring_matrix(self, filters):
+        """(rows, matrix) to score for the filters; rows is None for the full index, empty if nothing matches"""
+        if not filters:
+            return None, self.tfidf_matrix
+        shard_value = filters.get(self.shard_by) if len(filters) == 1 else None
+        shard = self.shards.get(self._facet_value(shard_value)) if isinstance(shard_value, (str, int)) else None
+        if shard is not None:
+            return shard
+        rows = self._filter_rows(filters)
+        if len(rows) == 0:
+            return rows, None
+        return rows, self.tfidf_matrix[rows]
+
+    def _rank(self, cosine_similarities, rows):
+        if self._score_boost is not None:
+            cosine_similarities = cosine_similarities * (self._score_boost if rows is None else self._score_boost[rows])
         
         # Get Top K indices
         related_docs_indices = cosine_similarities.argsort()[::-1][:TOP_K_RETRIEVE]
@@ -165,45 +522,201 @@ class RAGService:
             if score <= 0: # If using TF-IDF, 0 means no keyword match
                 continue
                 
-            meta = self.metadata[i]
-            results.append({
-                "score": float(score),
-                "text": meta["text"],
-                "source_id": meta["source_id"]
-            })
+            results.append(self._result(self.metadata[i if rows is None else rows[i]], score))
         return results
 
-    def answer_query(self, query, api_key=None):
-        if api_key:
-            self.perplexity_api_key = api_key
-            
-        retrieved = self.retrieve(query)
-        
-        # Build Context with simplified IDs
-        context_parts = []
-        curr_len = 0
+    @staticmethod
+    def _result(meta, score):
+        result = {
+            "score": float(score),
+            "text": meta["text"],
+            "source_id": meta["source_id"]
+        }
+        if meta.get("duplicate_count", 1) > 1:
+            result["duplicate_count"] = meta["duplicate_count"]
+        if "solution" in meta:
+            result["title"] = meta["title"]
+            result["solution"] = meta["solution"]
+        return result
+
+    def _use_remote(self):
+        return self.retrieval_client is not None and time.monotonic() >= self._remote_retry_at
+
+    def _remote_failed(self, e):
+        print(f"Retrieval server unavailable ({e}); using in-process index for {REMOTE_RETRY_SECONDS}s")
+        self._remote_retry_at = time.monotonic() + REMOTE_RETRY_SECONDS
+        self._ensure_local_index()
+
+    def retrieve(self, query, filters=None):
+        if self._use_remote():
+            try:
+                with span("rag.remote_retrieve"):
+                    return self.retrieval_client.retrieve(query, filters=filters)
+            except ConnectionError as e:
+                self._remote_failed(e)
+
+        if self.vectorizer is None or self.tfidf_matrix is None:
+            return []
+
+        # Restrict scoring to the rows matching the filters
+        rows, matrix = self._scoring_matrix(filters)
+        if matrix is None:
+            return []
         
-        # Create a mapping for the prompt
-        doc_map = {} 
+        with span("rag.transform"):
+            query_vec = self.vectorizer.transform([self._normalize_query(query)])
         
-        for idx, r in enumerate(retrieved[:FINAL_K]):
-            doc_id = f"[{idx+1}]"
-            doc_map[doc_id] = r['source_id'] # Keep track for logging if needed
+        # Calculate Cosine Similarity
+        with span("rag.cosine_similarity", rows=matrix.shape[0]):
+            cosine_similarities = cosine_similarity(query_vec, matrix).flatten()
+        with span("rag.rank"):
+            return self._rank(cosine_similarities, rows)
+
+    def retrieve_many(self, queries, filters=None):
+        """Batch retrieve: one transform and one sparse product for all queries"""
+        if self._use_remote():
+            try:
+                with span("rag.remote_retrieve_many", queries=len(queries)):
+                    return self.retrieval_client.retrieve_many(queries, filters=filters)
+            except ConnectionError as e:
+                self._remote_failed(e)
+
+        if not queries or self.vectorizer is None or self.tfidf_matrix is None:
+            return [[] for _ in queries]
+
+        rows, matrix = self._scoring_matrix(filters)
+        if matrix is None:
+            return [[] for _ in queries]
+
+        with span("rag.transform", queries=len(queries)):
+            query_vecs = self.vectorizer.transform([self._normalize_query(q) for q in queries])
+        with span("rag.cosine_similarity", rows=matrix.shape[0]):
+            similarities = cosine_similarity(query_vecs, matrix)
+        with span("rag.rank"):
+            return [self._rank(row, rows) for row in similarities]
+
+    def get_documents(self, source_ids):
+        """Look up indexed documents by source_id (score 0); unknown ids are skipped"""
+        if self._use_remote():
+            try:
+                with span("rag.remote_documents"):
+                    return self.retrieval_client.documents(source_ids)
+            except ConnectionError as e:
+                self._remote_failed(e)
+
+        rows = [self._source_rows.get(source_id) for source_id in source_ids]
+        return [self._result(self.metadata[i], 0.0) for i in rows if i is not None]
+
+    def get_index_info(self):
+        """Document count, filterable columns and build stats of the index serving retrieve()"""
+        if self._use_remote():
+            try:
+                return self.retrieval_client.info()
+            except ConnectionError as e:
+                self._remote_failed(e)
+        return {
+            "doc_count": self.tfidf_matrix.shape[0] if self.tfidf_matrix is not None else 0,
+            "filter_columns": sorted(self.facets),
+            "index_stats": self.index_stats
+        }
+
+    def _record(self, path, context_stats=None):
+        with self._metrics_lock:
+            self.metrics["queries"] += 1
+            self.metrics[path] += 1
+            if context_stats:
+                self.metrics["context_tokens"] += context_stats["context_tokens"]
+                self.metrics["context_tokens_saved"] += context_stats["tokens_saved"]
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self.metrics)
+        metrics["fast_path_rate"] = metrics["fast_path"] / metrics["queries"] if metrics["queries"] else 0.0
+        if self.speller is not None:
+            metrics["spelling"] = self.speller.stats()
+        return metrics
+
+    def _fast_path_answer(self, retrieved):
+        """Templated answer when the top hit is a confident, clear match that carries a solution"""
+        if not retrieved or "solution" not in retrieved[0]:
+            return None
+        top = retrieved[0]
+        runner_up = retrieved[1]["score"] if len(retrieved) > 1 else 0.0
+        if top["score"] < FAST_PATH_MIN_SCORE or top["score"] - runner_up < FAST_PATH_MIN_MARGIN:
+            return None
+        return f"**{top['title']}**\n\n{top['solution']} [1]"
+
+    def _merge_prior_sources(self, retrieved, prior_sources):
+        """Add the previous turn's docs ({"source_id", "score"}) to this turn's hits, best scores first"""
+        seen = {r["source_id"] for r in retrieved}
+        scores = {p["source_id"]: p["score"] for p in prior_sources if p["source_id"] not in seen}
+        carried = self.get_documents(list(scores))
+        for doc in carried:
+            doc["score"] = scores[doc["source_id"]]
+            doc["carried_over"] = True
+        return sorted(retrieved + carried, key=lambda r: r["score"], reverse=True)[:TOP_K_RETRIEVE]
+
+    def answer_query(self, query, api_key=None, filters=None, fast_path=FAST_PATH_ENABLED,
+                     use_cache=ANSWER_CACHE_ENABLED, retrieval_query=None, prior_sources=None,
+                     history=None, max_docs=FINAL_K, retrieved=None):
+        """Answer a query from retrieved logs.
+
+        For conversation follow-ups, retrieval_query is the new message alone,
+        prior_sources carries the previous turn's docs over and history is a
+        compact summary of the conversation, added to the prompt. retrieved
+        takes hits the caller already has for retrieval_query (or query).
+        """
+        if api_key:
+            self.perplexity_api_key = api_key
             
-            block = f"{doc_id}\n{r['text']}\n"
-            if curr_len + len(block) > MAX_CONTEXT_CHARS:
-                break
-            context_parts.append(block)
-            curr_len += len(block)
+        with span("rag.retrieve"):
+            if retrieved is None:
+                retrieved = self.retrieve(retrieval_query or query, filters=filters)
+            if prior_sources:
+                retrieved = self._merge_prior_sources(retrieved, prior_sources)
+
+        if fast_path:
+            answer = self._fast_path_answer(retrieved)
+            if answer:
+                self._record("fast_path")
+                return {
+                    "answer": answer,
+                    "context": f"[1]\n{retrieved[0]['text']}\n",
+                    "sources": retrieved,
+                    "escalation": False,
+                    "path": "fast_path"
+                }
+
+        cache_sources = [r["source_id"] for r in retrieved[:max_docs]]
+        if use_cache:
+            with span("rag.cache_lookup"):
+                cached = self.answer_cache.lookup(query, cache_sources)
+            if cached:
+                self._record("cache")
+                cached["path"] = "cache"
+                return cached
         
-        context = "\n".join(context_parts)
+        # Build Context with simplified IDs: near-duplicates dropped, docs trimmed to the token budget
+        with span("rag.build_context"):
+            context, used, context_stats = build_context(
+                query, retrieved, max_docs=max_docs, max_tokens=MAX_CONTEXT_TOKENS,
+                dedup_threshold=NEAR_DUPLICATE_THRESHOLD, max_sentences=MAX_SENTENCES_PER_DOC,
+                max_chars=MAX_CONTEXT_CHARS, keep_fields=SOLUTION_COLUMN_KEYWORDS
+            )
+
+        # Cited docs first so sources[i] matches citation [i+1]
+        used_ids = {r["source_id"] for r in used}
+        retrieved = used + [r for r in retrieved if r["source_id"] not in used_ids]
         
         if not self.perplexity_api_key:
+            self._record("retrieval_only")
             return {
                 "answer": "Perplexity API Key is missing. I can only retrieve documents.",
                 "context": context,
                 "sources": retrieved,
-                "escalation": True
+                "escalation": True,
+                "context_stats": context_stats,
+                "path": "retrieval_only"
             }
 
         # Call Perplexity
@@ -229,18 +742,18 @@ ESCALATION:
 - If the logs do not contain enough information to answer confidently, say so politely.
 - In that case, recommend escalation to a human support agent."""
         
-        print(f"DEBUG: Sending to Perplexity (Context Metadata: {[r['source_id'] for r in retrieved[:FINAL_K]]})")
+        print(f"DEBUG: Sending to Perplexity (Context Metadata: {[r['source_id'] for r in used]}, "
+              f"~{context_stats['context_tokens']} tokens, {context_stats['tokens_saved']} saved)")
 
+        user_content = f"HISTORICAL LOGS:\n{context}\n\nUSER QUERY:\n{query}"
+        if history:
+            user_content = f"CONVERSATION SO FAR:\n{history}\n\n{user_content}"
         messages = [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"HISTORICAL LOGS:\n{context}\n\nUSER QUERY:\n{query}"}
+            {"role": "user", "content": user_content}
         ]
         
-        url = "https://api.perplexity.ai/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {self.perplexity_api_key}",
-            "Content-Type": "application/json"
-        }
+        api_key = self.perplexity_api_key
         payload = {
             "model": PERPLEXITY_MODEL,
             "messages": messages,
@@ -262,33 +775,75 @@ ESCALATION:
             should_escalate = True
             print(f"DEBUG: Escalate due to low similarity ({max_score:.3f} < {SIMILARITY_THRESHOLD})")
 
+        self._record("llm", context_stats)
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=30)
-            if resp.status_code == 200:
-                data = resp.json()
+            status_code, body = self._call_upstream(api_key, payload)
+            if status_code == 200:
+                data = json.loads(body)
                 answer = data["choices"][0]["message"]["content"]
                 
                 # Secondary escalation check: if model is uncertain
                 if "not enough information" in answer.lower() or "i cannot answer" in answer.lower():
                     should_escalate = True
 
-                return {
+                result = {
                     "answer": answer,
                     "context": context,
                     "sources": retrieved,
-                    "escalation": should_escalate
+                    "escalation": should_escalate,
+                    "context_stats": context_stats,
+                    "path": "llm"
                 }
+                if use_cache:
+                    self.answer_cache.store(query, cache_sources, result)
+                return result
             else:
                 return {
-                    "answer": f"Error from Perplexity: {resp.text}",
+                    "answer": f"Error from Perplexity: {body}",
                     "context": context,
                     "sources": retrieved,
-                    "escalation": True
+                    "escalation": True,
+                    "context_stats": context_stats,
+                    "path": "llm"
                 }
+        except UpstreamBusy:
+            return {
+                "answer": "We're receiving a very high number of requests right now. Please try again in a moment.",
+                "context": context,
+                "sources": retrieved,
+                "escalation": True,
+                "busy": True,
+                "context_stats": context_stats,
+                "path": "llm"
+            }
         except Exception as e:
             return {
                 "answer": f"Exception calling Perplexity: {str(e)}",
                 "context": context,
                 "sources": retrieved,
-                "escalation": True
+                "escalation": True,
+                "context_stats": context_stats,
+                "path": "llm"
             }
+
+    def _call_upstream(self, api_key, payload):
+        """POST to Perplexity, coalescing identical in-flight prompts. Returns (status_code, body text)."""
+        key = hashlib.sha256(json.dumps([api_key, payload], sort_keys=True).encode("utf-8")).hexdigest()
+
+        def post():
+            with self._upstream_limiter, span("rag.upstream_post"):
+                resp = requests.post(PERPLEXITY_URL, headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                }, json=payload, timeout=30)
+                return resp.status_code, resp.text
+
+        # Includes time spent queued behind the limiter or waiting on a coalesced leader
+        with span("rag.upstream"):
+            return self._inflight.do(key, post)
+
+    def upstream_stats(self):
+        return {
+            "coalescing": self._inflight.stats(),
+            "limiter": self._upstream_limiter.stats()
+        }
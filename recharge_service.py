@@ -1,6 +1,7 @@
 import json
 import os
 from datetime import datetime, timedelta
+from profiling import span
 
 class RechargeService:
     def __init__(self, data_dir="data"):
@@ -177,7 +178,7 @@ class RechargeService:
     def get_all_plans(self):
         """Get all available plans"""
         try:
-            with open(self.plans_file, 'r') as f:
+            with span("recharge.load_plans"), open(self.plans_file, 'r') as f:
                 return json.load(f)
         except Exception as e:
             print(f"Error loading plans: {e}")
@@ -218,60 +219,61 @@ class RechargeService:
     
     def search_plans(self, query):
         """Search plans based on query for AI integration"""
-        query_lower = query.lower()
+        with span("recharge.search_plans"):
+            query_lower = query.lower()
         
-        # Detect intent
-        is_prepaid = any(word in query_lower for word in ["prepaid", "recharge", "topup", "top up"])
-        is_postpaid = any(word in query_lower for word in ["postpaid", "bill", "monthly"])
-        is_data_only = any(word in query_lower for word in ["data only", "internet only"])
-        is_long_validity = any(word in query_lower for word in ["annual", "yearly", "long term", "365"])
+            # Detect intent
+            is_prepaid = any(word in query_lower for word in ["prepaid", "recharge", "topup", "top up"])
+            is_postpaid = any(word in query_lower for word in ["postpaid", "bill", "monthly"])
+            is_data_only = any(word in query_lower for word in ["data only", "internet only"])
+            is_long_validity = any(word in query_lower for word in ["annual", "yearly", "long term", "365"])
         
-        result = "📱 **Available Recharge Plans**\n\n"
+            result = "📱 **Available Recharge Plans**\n\n"
         
-        if is_data_only:
-            plans = self.get_prepaid_plans("data_only")
-            result += "🌐 **Data Only Plans:**\n"
-            for plan in plans:
-                result += f"• **{plan['name']}** - ₹{plan['price']}\n"
-                result += f"  Data: {plan['data']}, Validity: {plan['validity']}\n\n"
+            if is_data_only:
+                plans = self.get_prepaid_plans("data_only")
+                result += "🌐 **Data Only Plans:**\n"
+                for plan in plans:
+                    result += f"• **{plan['name']}** - ₹{plan['price']}\n"
+                    result += f"  Data: {plan['data']}, Validity: {plan['validity']}\n\n"
         
-        elif is_long_validity:
-            plans = self.get_prepaid_plans("long_validity")
-            result += "📅 **Long Validity Plans:**\n"
-            for plan in plans:
-                result += f"• **{plan['name']}** - ₹{plan['price']}\n"
-                result += f"  Data: {plan['data']}, Validity: {plan['validity']}\n"
-                if plan.get('ott'):
-                    result += f"  OTT: {', '.join(plan['ott'])}\n"
-                result += "\n"
+            elif is_long_validity:
+                plans = self.get_prepaid_plans("long_validity")
+                result += "📅 **Long Validity Plans:**\n"
+                for plan in plans:
+                    result += f"• **{plan['name']}** - ₹{plan['price']}\n"
+                    result += f"  Data: {plan['data']}, Validity: {plan['validity']}\n"
+                    if plan.get('ott'):
+                        result += f"  OTT: {', '.join(plan['ott'])}\n"
+                    result += "\n"
         
-        elif is_postpaid:
-            plans = self.get_postpaid_plans()
-            result += "💼 **Postpaid Plans:**\n"
-            for plan in plans:
-                result += f"• **{plan['name']}** - ₹{plan['price']}/month\n"
-                result += f"  Data: {plan['data']}, Connections: {plan['connections']}\n"
-                if plan.get('ott'):
-                    result += f"  OTT: {', '.join(plan['ott'])}\n"
-                if plan.get('popular'):
-                    result += f"  ⭐ Popular Choice\n"
-                result += "\n"
+            elif is_postpaid:
+                plans = self.get_postpaid_plans()
+                result += "💼 **Postpaid Plans:**\n"
+                for plan in plans:
+                    result += f"• **{plan['name']}** - ₹{plan['price']}/month\n"
+                    result += f"  Data: {plan['data']}, Connections: {plan['connections']}\n"
+                    if plan.get('ott'):
+                        result += f"  OTT: {', '.join(plan['ott'])}\n"
+                    if plan.get('popular'):
+                        result += f"  ⭐ Popular Choice\n"
+                    result += "\n"
         
-        else:  # Default: Show popular prepaid unlimited plans
-            plans = self.get_prepaid_plans("unlimited")
-            result += "🔥 **Popular Unlimited Plans:**\n"
-            for plan in plans:
-                if plan.get('popular'):
-                    result += f"• **{plan['name']}** - ₹{plan['price']} ⭐\n"
-                else:
-                    result += f"• **{plan['name']}** - ₹{plan['price']}\n"
-                result += f"  Data: {plan['data']}, Validity: {plan['validity']}\n"
-                result += f"  5G: {'Yes' if plan.get('unlimited_5g') else 'No'}\n"
-                if plan.get('ott'):
-                    result += f"  OTT: {', '.join(plan['ott'])}\n"
-                result += "\n"
+            else:  # Default: Show popular prepaid unlimited plans
+                plans = self.get_prepaid_plans("unlimited")
+                result += "🔥 **Popular Unlimited Plans:**\n"
+                for plan in plans:
+                    if plan.get('popular'):
+                        result += f"• **{plan['name']}** - ₹{plan['price']} ⭐\n"
+                    else:
+                        result += f"• **{plan['name']}** - ₹{plan['price']}\n"
+                    result += f"  Data: {plan['data']}, Validity: {plan['validity']}\n"
+                    result += f"  5G: {'Yes' if plan.get('unlimited_5g') else 'No'}\n"
+                    if plan.get('ott'):
+                        result += f"  OTT: {', '.join(plan['ott'])}\n"
+                    result += "\n"
         
-        return result
+            return result
     
     def get_plan_by_id(self, plan_id):
         """Get a specific plan by ID"""
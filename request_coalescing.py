@@ -0,0 +1,125 @@
+import threading
+import time
+
+
+class UpstreamBusy(Exception):
+    """Raised when the upstream limiter's wait queue is full or the wait timed out"""
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The first caller (the leader) runs the function; callers arriving while it
+    is in flight block and receive the leader's result (or exception).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.shared += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "shared": self.shared,
+            }
+
+
+class ConcurrencyLimiter:
+    """Bounds concurrent upstream calls, with a bounded FIFO-ish wait queue.
+
+    Callers beyond max_concurrent wait for a slot; once max_queue callers are
+    already waiting, new callers fail fast with UpstreamBusy instead of piling
+    up until the HTTP timeout.
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self.rejected = 0
+
+    def acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            if self._active >= self.max_concurrent and self._waiting >= self.max_queue:
+                self.rejected += 1
+                raise UpstreamBusy("Upstream queue is full")
+            self._waiting += 1
+            try:
+                while self._active >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise UpstreamBusy("Timed out waiting for an upstream slot")
+                    self._cond.wait(remaining)
+                self._active += 1
+            finally:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": self._active,
+                "waiting": self._waiting,
+                "rejected": self.rejected,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+            }
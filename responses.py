@@ -0,0 +1,96 @@
+import gzip
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024   # Smaller bodies are sent as-is; compression overhead isn't worth it
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4          # Low qualities are close to gzip speed with a better ratio
+
+
+def dumps(payload):
+    """Serialize to JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def select_fields(payload, fields):
+    """Keep only the requested top-level keys ("answer,escalation" or a list); None keeps everything.
+
+    An "error" key is always kept.
+    """
+    if not fields or not isinstance(payload, dict) or not isinstance(fields, (str, list, tuple)):
+        return payload
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    wanted = {f.strip() for f in fields if f.strip()} | {"error"}
+    return {k: v for k, v in payload.items() if k in wanted}
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick br or gzip from an Accept-Encoding header (honouring q=0), else None.
+
+    A "*" wildcard only stands for codings the header does not refuse explicitly.
+    """
+    accepted = set()
+    refused = set()
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    refused.add(coding)
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+
+    def allowed(coding):
+        return coding in accepted or ("*" in accepted and coding not in refused)
+
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if allowed("gzip"):
+        return "gzip"
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def json_response(payload, status=200, headers=None, fields=None):
+    """JSON response with field selection and negotiated compression.
+
+    fields defaults to the ?fields= query parameter, so clients can drop heavy
+    keys such as context and sources.
+    """
+    if fields is None:
+        fields = request.args.get("fields")
+    body = dumps(select_fields(payload, fields))
+
+    response = Response(body, status=status, mimetype="application/json")
+    response.headers["Vary"] = "Accept-Encoding"
+    if len(body) >= COMPRESS_MIN_BYTES:
+        encoding = negotiate_encoding(request.headers.get("Accept-Encoding"))
+        if encoding:
+            response.set_data(compress(body, encoding))
+            response.headers["Content-Encoding"] = encoding
+    if headers:
+        response.headers.update(headers)
+    return response
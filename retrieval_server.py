@@ -0,0 +1,229 @@
+"""Standalone retrieval daemon: one process holds the TF-IDF index and serves
+retrieve / retrieve_many / document lookups to any number of web workers over
+a Unix socket or TCP.
+
+Usage:
+    python retrieval_server.py unix:/tmp/rag_retrieval.sock [data_dir]
+    python retrieval_server.py tcp:127.0.0.1:7070 [data_dir]
+
+Point the web app at it with RETRIEVAL_SERVER=<same address>.
+
+Wire format: every frame is a 5-byte header (uint32 body length, uint8 op or
+status, big-endian) followed by the body. Bodies are JSON (orjson when
+installed). Connections are persistent, so clients pool and reuse them.
+"""
+import os
+import sys
+import json
+import queue
+import socket
+import struct
+import socketserver
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+HEADER = struct.Struct("!IB")
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+OP_RETRIEVE = 1
+OP_RETRIEVE_MANY = 2
+OP_INFO = 3
+OP_DOCUMENTS = 4
+
+STATUS_OK = 0
+STATUS_BAD_REQUEST = 1
+STATUS_ERROR = 2
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def send_frame(sock, code, obj):
+    body = _dumps(obj)
+    sock.sendall(HEADER.pack(len(body), code) + body)
+
+
+def recv_frame(sock):
+    length, code = HEADER.unpack(_recv_exact(sock, HEADER.size))
+    if length > MAX_FRAME_BYTES:
+        raise ConnectionError(f"Frame too large: {length} bytes")
+    return code, _loads(_recv_exact(sock, length))
+
+
+def parse_address(address):
+    """'unix:/path.sock' -> (AF_UNIX, path); 'tcp:host:port' or 'host:port' -> (AF_INET, (host, port))"""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    if address.startswith("tcp:"):
+        address = address[len("tcp:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+class RetrievalClient:
+    """Pooled client for the retrieval daemon.
+
+    Raises ConnectionError when the daemon cannot be reached (callers fall back
+    to an in-process index) and ValueError for requests the daemon rejected.
+    """
+
+    def __init__(self, address, pool_size=8, timeout=2.0):
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.sockaddr)
+        except OSError:
+            sock.close()
+            raise
+        if self.family == socket.AF_INET:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _request(self, op, body):
+        try:
+            sock = self._idle.get_nowait()
+        except queue.Empty:
+            sock = None
+        try:
+            if sock is None:
+                sock = self._connect()
+            send_frame(sock, op, body)
+            status, reply = recv_frame(sock)
+        except (OSError, ConnectionError, ValueError) as e:
+            if sock is not None:
+                sock.close()
+            raise ConnectionError(f"Retrieval server {self.address}: {e}") from e
+
+        try:
+            self._idle.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+        if status == STATUS_BAD_REQUEST:
+            raise ValueError(reply.get("error"))
+        if status != STATUS_OK:
+            raise ConnectionError(f"Retrieval server error: {reply.get('error')}")
+        return reply
+
+    def retrieve(self, query, filters=None):
+        return self._request(OP_RETRIEVE, {"query": query, "filters": filters})
+
+    def retrieve_many(self, queries, filters=None):
+        return self._request(OP_RETRIEVE_MANY, {"queries": queries, "filters": filters})
+
+    def info(self):
+        return self._request(OP_INFO, {})
+
+    def documents(self, source_ids):
+        return self._request(OP_DOCUMENTS, {"source_ids": source_ids})
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        rag = self.server.rag
+        while True:
+            try:
+                op, body = recv_frame(self.request)
+            except (ConnectionError, OSError, ValueError):
+                return
+            try:
+                if op == OP_RETRIEVE:
+                    reply = rag.retrieve(body["query"], filters=body.get("filters"))
+                elif op == OP_RETRIEVE_MANY:
+                    reply = rag.retrieve_many(body["queries"], filters=body.get("filters"))
+                elif op == OP_INFO:
+                    reply = rag.get_index_info()
+                elif op == OP_DOCUMENTS:
+                    reply = rag.get_documents(body["source_ids"])
+                else:
+                    send_frame(self.request, STATUS_BAD_REQUEST, {"error": f"Unknown op {op}"})
+                    continue
+                send_frame(self.request, STATUS_OK, reply)
+            except (KeyError, ValueError) as e:
+                send_frame(self.request, STATUS_BAD_REQUEST, {"error": str(e)})
+            except Exception as e:
+                send_frame(self.request, STATUS_ERROR, {"error": str(e)})
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+def make_server(address, rag):
+    family, sockaddr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+        server = _ThreadingUnixServer(sockaddr, _Handler)
+    else:
+        server = _ThreadingTCPServer(sockaddr, _Handler)
+    server.rag = rag
+    return server
+
+
+def serve_in_thread(address, rag):
+    """Start a server on a background thread (for tests and benchmarks); returns the server"""
+    server = make_server(address, rag)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    from rag_service import RAGService
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    listen = sys.argv[1]
+    rag = RAGService(data_dir=sys.argv[2] if len(sys.argv) > 2 else "data")
+    server = make_server(listen, rag)
+    print(f"Retrieval server listening on {listen} ({rag.get_index_info()['doc_count']} documents)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,144 @@
+import json
+import re
+import time
+import secrets
+import threading
+from collections import OrderedDict
+
+SESSION_TTL_SECONDS = 30 * 60     # Idle sessions expire after this long
+SESSION_MAX_SESSIONS = 10000
+SESSION_MAX_BYTES = 8 * 1024      # Serialized size cap per session
+SESSION_SUMMARY_TURNS = 3         # Turns kept in the compact conversation summary
+SUMMARY_QUERY_CHARS = 200
+SUMMARY_ANSWER_CHARS = 300
+
+FOLLOW_UP_MAX_WORDS = 10          # Longer messages stand on their own
+FOLLOW_UP_STANDALONE_SCORE = 0.45 # A follow-up-looking message whose own top hit is this confident...
+FOLLOW_UP_STANDALONE_MARGIN = 0.15 # ...and this far ahead of the carried-over docs starts afresh
+FOLLOW_UP_START_RE = re.compile(r"^\s*(what about|how about|and|also|what if|then|ok|okay|same|instead)\b", re.I)
+FOLLOW_UP_REFERENCE_RE = re.compile(r"\b(it|that|this|those|these|them|one|ones|same|instead|which)\b", re.I)
+
+
+def is_follow_up(query, session):
+    """Heuristic: a short message in a live session that opens with a continuation
+    ("what about...", "and...") or refers back to something ("that one", "it")"""
+    if not session or not session.get("turns") or len(query.split()) > FOLLOW_UP_MAX_WORDS:
+        return False
+    return bool(FOLLOW_UP_START_RE.search(query) or FOLLOW_UP_REFERENCE_RE.search(query))
+
+
+def stands_alone(retrieved, session):
+    """True when the message's own retrieval clearly beats the previous turn's docs,
+    i.e. it changes the subject and should not inherit the session's context"""
+    top = retrieved[0]["score"] if retrieved else 0.0
+    best_prior = max((s["score"] for s in session.get("sources", [])), default=0.0)
+    return top >= FOLLOW_UP_STANDALONE_SCORE and top - best_prior >= FOLLOW_UP_STANDALONE_MARGIN
+
+
+def _clip(text, limit):
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+
+def summarize_turns(turns):
+    """Compact conversation summary for the prompt"""
+    return "\n".join(f"User: {t['user']}\nAssistant: {t['assistant']}" for t in turns)
+
+
+def record_turn(session, query, answer):
+    """Append a clipped turn, keeping only the last SESSION_SUMMARY_TURNS"""
+    turns = session.setdefault("turns", [])
+    turns.append({"user": _clip(query, SUMMARY_QUERY_CHARS), "assistant": _clip(answer, SUMMARY_ANSWER_CHARS)})
+    del turns[:-SESSION_SUMMARY_TURNS]
+
+
+class SessionStore:
+    """Bounded in-process session store: LRU over at most `max_sessions`, idle
+    expiry after `ttl` seconds, and a serialized size cap per session.
+
+    Sessions are plain JSON-able dicts. An oversized session first loses its
+    oldest turns, then its domain context, then its carried-over sources.
+    """
+
+    def __init__(self, max_sessions=SESSION_MAX_SESSIONS, ttl=SESSION_TTL_SECONDS,
+                 max_session_bytes=SESSION_MAX_BYTES):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_session_bytes = max_session_bytes
+        self._sessions = OrderedDict()   # id -> (last access, session, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0, "trimmed": 0}
+
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(16)
+
+    def _drop(self, session_id):
+        _, _, size = self._sessions.pop(session_id)
+        self._bytes -= size
+
+    def _expire(self, now):
+        # Entries are ordered by last access, so expired ones are at the front
+        while self._sessions:
+            session_id, (accessed, _, _) = next(iter(self._sessions.items()))
+            if now - accessed < self.ttl:
+                return
+            self._drop(session_id)
+            self._stats["expired"] += 1
+
+    def get(self, session_id):
+        """A copy of the session, or None if it is unknown or expired"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(session_id) if session_id else None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._sessions[session_id] = (now, entry[1], entry[2])
+            self._sessions.move_to_end(session_id)
+            self._stats["hits"] += 1
+            return json.loads(entry[1])
+
+    def _fit(self, session):
+        """(serialized session, trimmed?) within the size cap; None if even the bare session is too big"""
+        session = dict(session, turns=list(session.get("turns", [])))
+        trimmed = False
+        while True:
+            body = json.dumps(session, ensure_ascii=False, separators=(",", ":"))
+            if len(body.encode("utf-8")) <= self.max_session_bytes:
+                return body, trimmed
+            trimmed = True
+            if session["turns"]:
+                session["turns"].pop(0)
+            elif session.get("domain_context"):
+                session.pop("domain_context")
+                session.pop("domain", None)
+            elif session.get("sources"):
+                session.pop("sources")
+            else:
+                return None, trimmed
+
+    def put(self, session_id, session):
+        """Store (a trimmed copy of) the session; returns False if it could not fit at all"""
+        body, trimmed = self._fit(session)
+        now = time.monotonic()
+        with self._lock:
+            self._stats["trimmed"] += trimmed
+            if session_id in self._sessions:
+                self._drop(session_id)
+            if body is None:
+                return False
+            size = len(body.encode("utf-8"))
+            self._sessions[session_id] = (now, body, size)
+            self._bytes += size
+            self._expire(now)
+            while len(self._sessions) > self.max_sessions:
+                self._drop(next(iter(self._sessions)))
+                self._stats["evicted"] += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, sessions=len(self._sessions), bytes=self._bytes)
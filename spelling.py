@@ -0,0 +1,146 @@
+import time
+import threading
+from collections import Counter, OrderedDict
+
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+from text_utils import TOKEN_RE, tokenize
+
+
+def _deletes(word, max_distance):
+    """Every string reachable from word by removing up to max_distance characters"""
+    result = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier if len(w) > 1 for i in range(len(w))}
+        result |= frontier
+    return result
+
+
+def edit_distance(a, b, max_distance):
+    """Optimal string alignment distance (adjacent transpositions count as one edit).
+
+    Returns max_distance + 1 as soon as the distance is known to exceed max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    prev2 = None
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > max_distance:
+            return max_distance + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class SpellCorrector:
+    """SymSpell-style corrector: dictionary terms are indexed by their deletes up
+    front, so a lookup only generates the deletes of the misspelled word and
+    verifies the few terms sharing one, instead of scanning the vocabulary.
+
+    Stop words and tokens with digits or under min_word_length characters are
+    never corrected. Words shorter than long_word_length get one edit, longer
+    ones max_edit_distance: a small domain vocabulary lacks many ordinary
+    words, and two edits would map those onto unrelated terms. Results are
+    kept in an LRU cache.
+    """
+
+    def __init__(self, term_counts, max_edit_distance=2, prefix_length=7, min_word_length=4,
+                 long_word_length=8, cache_size=4096):
+        self.term_counts = dict(term_counts)
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.min_word_length = min_word_length
+        self.long_word_length = long_word_length
+        self.cache_size = cache_size
+
+        self._index = {}
+        for term in self.term_counts:
+            for d in _deletes(term[:prefix_length], max_edit_distance):
+                self._index.setdefault(d, []).append(term)
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "tokens": 0, "corrected": 0, "cache_hits": 0, "total_us": 0.0}
+
+    @classmethod
+    def from_texts(cls, texts, vocabulary=None, **kwargs):
+        """Term frequencies from the indexed texts, optionally limited to the vectorizer's vocabulary"""
+        counts = Counter(t for text in texts for t in tokenize(text))
+        terms = {t: n for t, n in counts.items()
+                 if t not in ENGLISH_STOP_WORDS and not any(c.isdigit() for c in t)
+                 and (vocabulary is None or t in vocabulary)}
+        return cls(terms, **kwargs)
+
+    def _lookup(self, word):
+        max_distance = 1 if len(word) < self.long_word_length else self.max_edit_distance
+        best = None
+        seen = set()
+        for d in _deletes(word[:self.prefix_length], max_distance):
+            for term in self._index.get(d, ()):
+                if term in seen:
+                    continue
+                seen.add(term)
+                distance = edit_distance(word, term, max_distance)
+                if distance <= max_distance:
+                    key = (distance, -self.term_counts[term], term)
+                    if best is None or key < best:
+                        best = key
+        return best[2] if best else word
+
+    def correct_word(self, word):
+        """The closest, most frequent dictionary term for an unknown word (else the word)"""
+        if (word in self.term_counts or word in ENGLISH_STOP_WORDS or len(word) < self.min_word_length
+                or any(c.isdigit() for c in word)):
+            return word
+        with self._lock:
+            if word in self._cache:
+                self._cache.move_to_end(word)
+                self._stats["cache_hits"] += 1
+                return self._cache[word]
+        corrected = self._lookup(word)
+        with self._lock:
+            self._cache[word] = corrected
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return corrected
+
+    def correct(self, text):
+        """Returns (text with unknown words replaced, [(original, correction), ...])"""
+        start = time.perf_counter()
+        corrections = []
+        tokens = 0
+
+        def replace(match):
+            nonlocal tokens
+            tokens += 1
+            word = match.group(0).lower()
+            corrected = self.correct_word(word)
+            if corrected != word:
+                corrections.append((word, corrected))
+                return corrected
+            return match.group(0)
+
+        corrected_text = TOKEN_RE.sub(replace, text)
+        elapsed_us = (time.perf_counter() - start) * 1e6
+        with self._lock:
+            self._stats["queries"] += 1
+            self._stats["tokens"] += tokens
+            self._stats["corrected"] += len(corrections)
+            self._stats["total_us"] += elapsed_us
+        return corrected_text, corrections
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cache_entries"] = len(self._cache)
+        stats["dictionary_terms"] = len(self.term_counts)
+        stats["avg_us_per_query"] = stats["total_us"] / stats["queries"] if stats["queries"] else 0.0
+        del stats["total_us"]
+        return stats
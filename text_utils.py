@@ -0,0 +1,57 @@
+import re
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+TOKEN_RE = re.compile(r"\b\w\w+\b")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+# Stop words that flip a query's meaning; sklearn's stop list includes them
+NEGATIONS = frozenset(["not", "no", "never", "cannot", "nor", "none", "nothing", "without",
+                       "dont", "doesnt", "didnt", "isnt", "wasnt", "cant", "wont", "couldnt"])
+NEGATION_RE = re.compile(r"\b(\w+)n't\b|\bcan't\b")
+
+
+def tokenize(text):
+    """Lowercased word tokens, same pattern as the TF-IDF vectorizer"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def content_terms(text):
+    """Tokens minus English stop words"""
+    return [t for t in tokenize(text) if t not in ENGLISH_STOP_WORDS]
+
+
+def negation_terms(text):
+    """Negation words in the text ("don't" counts as "dont")"""
+    text = NEGATION_RE.sub(lambda m: "cant" if m.group(0) == "can't" else f"{m.group(1)}nt", text.lower())
+    return frozenset(t for t in tokenize(text) if t in NEGATIONS)
+
+
+def estimate_tokens(text):
+    """Cheap LLM token estimate (~4 characters per token for English)"""
+    return (len(text) + 3) // 4
+
+
+def split_sentences(text):
+    return [s.strip() for s in SENTENCE_RE.split(text) if s and s.strip()]
+
+
+def shingles(text, k=3):
+    """Set of k-word shingles; short texts fall back to their unique terms"""
+    terms = content_terms(text)
+    if len(terms) < k:
+        return set(terms)
+    return {" ".join(terms[i:i + k]) for i in range(len(terms) - k + 1)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def char_shingles(text, n=3):
+    """Character n-grams of each content term and negation (with word boundary markers), robust to phrasing and typos"""
+    grams = set()
+    for term in content_terms(text) + sorted(negation_terms(text)):
+        padded = f"#{term}#"
+        grams.update(padded[i:i + n] for i in range(max(len(padded) - n + 1, 1)))
+    return grams